@@ -0,0 +1,24 @@
+import os
+import threading
+
+
+def write_atomically(path, write, binary=False):
+    '''Replace the file at path with what write(stream) writes to it
+
+    The content goes to a temporary file that then replaces path, so a
+    reader, e.g. the next run or a metrics collector, never sees a partial
+    file. The temporary file is named after the process and thread, so
+    processes sharing a cache directory, such as shards, never write into
+    each other's.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temp_file = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    try:
+        with open(temp_file, 'wb' if binary else 'w') as stream:
+            write(stream)
+        os.replace(temp_file, path)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
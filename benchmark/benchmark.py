@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+'''End-to-end import benchmark against the in-process fake NetBox
+
+Imports a synthetic library of N vendors x M device and module types in
+four scenarios that share one NetBox and one cache directory:
+
+cold       empty NetBox and cache
+unchanged  second run without any change to the library
+changed    one device type gained an interface since the last run
+full       --full run against the populated NetBox
+
+For every scenario the wall time, the number of requests per endpoint and
+the bytes sent and received are reported. With --targets the library is
+imported into several fake NetBox instances at once, and their requests
+are added up. With --baseline the request
+counts are compared with a recorded run and the benchmark exits non-zero
+if any endpoint needs more requests than recorded.
+
+    python benchmark/benchmark.py --vendors 20 --types 40 --latency 0.005
+'''
+from argparse import ArgumentParser, Namespace
+from collections import Counter
+from contextlib import ExitStack, redirect_stdout
+from datetime import datetime
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+from git import Actor, Repo
+import yaml
+
+BENCHMARK_PATH = os.path.dirname(os.path.realpath(__file__))
+PACKAGE_PATH = os.path.dirname(BENCHMARK_PATH)
+sys.path.insert(0, PACKAGE_PATH)
+
+from fake_netbox import FakeNetBox  # noqa: E402
+from log_handler import LogHandler  # noqa: E402
+from metrics import Metrics  # noqa: E402
+from repo import DTLRepo, start_parse_pool  # noqa: E402
+
+SCENARIOS = ('cold', 'unchanged', 'changed', 'full')
+AUTHOR = Actor('benchmark', 'benchmark@example.com')
+
+
+def write_definition(path, definition):
+    with open(path, 'w') as stream:
+        yaml.safe_dump(definition, stream, sort_keys=False)
+
+
+def device_type_definition(vendor, number):
+    slug = f'{vendor.lower()}-model-{number}'
+    definition = {
+        'manufacturer': vendor,
+        'model': f'{vendor} Model {number}',
+        'slug': slug,
+        'part_number': f'PN{number}',
+        'u_height': 1,
+        'interfaces': [{'name': f'eth{i}', 'type': '1000base-t', 'mgmt_only': i == 0} for i in range(8)],
+        'console-ports': [{'name': 'con0', 'type': 'rj-45'}],
+        'power-ports': [{'name': f'PSU{i}', 'type': 'iec-60320-c14', 'maximum_draw': 100} for i in range(2)],
+        'power-outlets': [{'name': f'out{i}', 'type': 'iec-60320-c13', 'power_port': 'PSU0', 'feed_leg': 'A'}
+                          for i in range(2)],
+        'rear-ports': [{'name': f'rear{i}', 'type': '8p8c', 'positions': 1} for i in range(2)],
+        'front-ports': [{'name': f'front{i}', 'type': '8p8c', 'rear_port': f'rear{i}', 'rear_port_position': 1}
+                        for i in range(2)],
+        'module-bays': [{'name': 'bay1', 'position': '1'}],
+    }
+    # Every other device type has a front image
+    if number % 2 == 0:
+        definition['front_image'] = True
+    return slug, definition
+
+
+def module_type_definition(vendor, number):
+    return {
+        'manufacturer': vendor,
+        'model': f'{vendor} Module {number}',
+        'part_number': f'MPN{number}',
+        'interfaces': [{'name': f'p{i}', 'type': '10gbase-x-sfpp'} for i in range(4)],
+        'power-ports': [{'name': 'PS', 'type': 'iec-60320-c14'}],
+        'power-outlets': [{'name': 'O1', 'type': 'iec-60320-c13', 'power_port': 'PS'}],
+        'rear-ports': [{'name': 'r1', 'type': 'lc'}],
+        'front-ports': [{'name': 'f1', 'type': 'lc', 'rear_port': 'r1'}],
+    }
+
+
+def generate_library(path, vendors, device_types):
+    '''Write a synthetic library of vendors x device_types definitions and commit it
+
+    Returns:
+    git.Repo of the library
+    '''
+    for vendor_number in range(vendors):
+        vendor = f'Vendor{vendor_number}'
+        for kind in ('device-types', 'module-types', 'elevation-images'):
+            os.makedirs(os.path.join(path, kind, vendor), exist_ok=True)
+        for number in range(device_types):
+            slug, definition = device_type_definition(vendor, number)
+            write_definition(os.path.join(path, 'device-types', vendor, f'{slug}.yaml'), definition)
+            if definition.get('front_image'):
+                with open(os.path.join(path, 'elevation-images', vendor, f'{slug}.front.png'), 'wb') as stream:
+                    stream.write(bytes([number % 256]) * 2048)
+            write_definition(os.path.join(path, 'module-types', vendor, f'module-{number}.yaml'),
+                             module_type_definition(vendor, number))
+
+    library = Repo.init(path)
+    library.git.symbolic_ref('HEAD', 'refs/heads/master')
+    library.git.add(A=True)
+    library.index.commit('Synthetic library', author=AUTHOR, committer=AUTHOR)
+    return library
+
+
+def change_library(library):
+    '''Add an interface to the first device type and commit the change'''
+    path = os.path.join(library.working_dir, 'device-types', 'Vendor0', 'vendor0-model-0.yaml')
+    with open(path, 'r') as stream:
+        definition = yaml.safe_load(stream)
+    definition['interfaces'].append({'name': 'eth-added', 'type': '10gbase-t'})
+    write_definition(path, definition)
+    library.git.add(A=True)
+    library.index.commit('Change one device type', author=AUTHOR, committer=AUTHOR)
+
+
+def load_importer():
+    spec = importlib.util.spec_from_file_location('nb_dt_import', os.path.join(PACKAGE_PATH, 'nb-dt-import.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_settings(bench_args, netbox_urls, library_url, workdir, full=False, parse_pool=None):
+    '''Stand-in for settings.py, which parses the command line and clones on import'''
+    settings = sys.modules['settings']
+    token = '0123456789abcdef0123456789abcdef01234567'
+    settings.args = Namespace(
+        vendors=[], slugs=[], targets=[], url=library_url, branch='master',
+        depth=0, filter=None, sparse=False, snapshot=None,
+        batch_size=bench_args.batch_size, workers=bench_args.workers,
+        parse_workers=bench_args.parse_workers, rate_limit=0, max_in_flight=0, max_latency=0,
+        full=full, reconcile=False, resume=False, daemon=False, interval=60, listen=None,
+        shard=None, result_file=None, merge=None,
+        metrics_file=None, prometheus_file=None, profile=None, log_format='text',
+        verbose=bench_args.verbose)
+    settings.NETBOX_URL = netbox_urls[0]
+    settings.NETBOX_TOKEN = token
+    settings.TARGETS = [(url, token) for url in netbox_urls]
+    settings.IGNORE_SSL_ERRORS = False
+    settings.NETBOX_PAGE_SIZE = bench_args.page_size
+    settings.HTTP_RETRIES = 5
+    settings.CACHE_PATH = os.path.join(workdir, 'cache')
+    settings.PARSE_CACHE_SIZE = 50000
+    settings.NETBOX_FEATURES = {'modules': False}
+    settings.handle = LogHandler(settings.args)
+    settings.metrics = Metrics(settings.handle)
+    settings.dtl_repo = DTLRepo(settings.args, os.path.join(workdir, 'repo'), settings.handle,
+                                settings.CACHE_PATH, settings.PARSE_CACHE_SIZE, parse_pool)
+    return settings
+
+
+def run_scenario(importer, fakes, bench_args, library, workdir, full=False, parse_pool=None):
+    '''Run one import and return its wall time and request accounting'''
+    for fake in fakes:
+        fake.state.reset_metrics()
+    output = io.StringIO()
+    start = datetime.now()
+    try:
+        with redirect_stdout(sys.stdout if bench_args.verbose else output):
+            build_settings(bench_args, [fake.url for fake in fakes], os.path.join(library.working_dir, '.git'),
+                           workdir, full, parse_pool)
+            importer.main()
+            sys.modules['settings'].handle.close()
+    except SystemExit:
+        print(output.getvalue(), file=sys.stderr)
+        raise
+    elapsed = (datetime.now() - start).total_seconds()
+    requests = Counter()
+    for fake in fakes:
+        requests.update({f'{method} {endpoint}': count for (method, endpoint), count in fake.state.requests.items()})
+    return {
+        'seconds': round(elapsed, 3),
+        'requests': sum(fake.state.total_requests() for fake in fakes),
+        'bytes_sent': sum(fake.state.bytes_in for fake in fakes),
+        'bytes_received': sum(fake.state.bytes_out for fake in fakes),
+        'endpoints': dict(sorted(requests.items())),
+    }
+
+
+def run_benchmark(bench_args):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='nb-dt-benchmark-')
+    sys.modules['settings'] = types.ModuleType('settings')
+    # Forked before the fake NetBox and log writer threads start, as settings.py does
+    parse_pool = start_parse_pool(bench_args.parse_workers)
+    try:
+        library = generate_library(os.path.join(workdir, 'library'), bench_args.vendors, bench_args.types)
+        importer = load_importer()
+        with ExitStack() as stack:
+            fakes = [stack.enter_context(FakeNetBox(latency=bench_args.latency)) for _ in range(bench_args.targets)]
+            for scenario in SCENARIOS:
+                if scenario == 'changed':
+                    change_library(library)
+                results[scenario] = run_scenario(importer, fakes, bench_args, library, workdir,
+                                                 scenario == 'full', parse_pool)
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_results(results):
+    for scenario, result in results.items():
+        print(f"{scenario}: {result['seconds']:.3f}s, {result['requests']} requests, "
+              + f"{result['bytes_sent']} bytes sent, {result['bytes_received']} bytes received")
+        for endpoint, count in result['endpoints'].items():
+            print(f'    {count:6d}  {endpoint}')
+
+
+def compare_baseline(results, baseline, tolerance):
+    '''Return a message for every endpoint that needs more requests than the baseline allows'''
+    regressions = []
+    for scenario, result in results.items():
+        recorded = baseline.get(scenario)
+        if recorded is None:
+            continue
+        counts = dict(result['endpoints'], total=result['requests'])
+        for endpoint, count in counts.items():
+            allowed = int(recorded.get(endpoint, 0) * (1 + tolerance))
+            if count > allowed:
+                regressions.append(f'{scenario}: {endpoint} took {count} requests, baseline allows {allowed}')
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the import against a local fake NetBox')
+    parser.add_argument('--vendors', type=int, default=3, help="Number of synthetic vendors")
+    parser.add_argument('--types', type=int, default=4,
+                        help="Number of device types and of module types per vendor")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds the fake NetBox waits before answering each request")
+    parser.add_argument('--targets', type=int, default=1,
+                        help="Number of fake NetBox instances imported into at once")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of device/module types imported concurrently")
+    parser.add_argument('--parse-workers', type=int, default=1,
+                        help="Number of processes used to parse the YAML files")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="Number of component templates sent per bulk request")
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help="Page size used when prefetching existing objects")
+    parser.add_argument('--baseline', default=None,
+                        help="JSON file with the request counts of a previous run")
+    parser.add_argument('--write-baseline', action='store_true', default=False,
+                        help="Record the request counts of this run in the --baseline file")
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help="Fraction of requests above the baseline that is not a regression")
+    parser.add_argument('--json', default=None, help="Write the results to this JSON file")
+    parser.add_argument('--verbose', action='store_true', default=False,
+                        help="Print the output of the imports")
+    bench_args = parser.parse_args()
+
+    results = run_benchmark(bench_args)
+    print_results(results)
+    if bench_args.json:
+        with open(bench_args.json, 'w') as stream:
+            json.dump(results, stream, indent=2)
+
+    if not bench_args.baseline:
+        return 0
+    # Request counts only compare between runs of the same library size
+    size = f'{bench_args.vendors}x{bench_args.types}'
+    if bench_args.targets > 1:
+        size = f'{size}x{bench_args.targets}'
+    baselines = {}
+    if os.path.isfile(bench_args.baseline):
+        with open(bench_args.baseline, 'r') as stream:
+            baselines = json.load(stream)
+    if bench_args.write_baseline:
+        baselines[size] = {scenario: dict(result['endpoints'], total=result['requests'])
+                           for scenario, result in results.items()}
+        with open(bench_args.baseline, 'w') as stream:
+            json.dump(baselines, stream, indent=2, sort_keys=True)
+            stream.write('\n')
+        return 0
+    if size not in baselines:
+        print(f'No baseline recorded for a {size} library in {bench_args.baseline}')
+        return 1
+    regressions = compare_baseline(results, baselines[size], bench_args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
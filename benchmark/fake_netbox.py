@@ -0,0 +1,376 @@
+'''In-process stand-in for the parts of the NetBox REST API the importer uses.
+
+Only what nb-dt-import.py touches is implemented: the API root and status,
+manufacturers, device/module types, every *-templates endpoint with
+pagination, filtering, bulk create, bulk update and multipart image uploads.
+Every request is recorded so callers can assert on the request pattern.
+'''
+from collections import Counter
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import json
+import threading
+import time
+
+API_VERSION = '3.5'
+
+TEMPLATE_ENDPOINTS = (
+    'interface-templates',
+    'power-port-templates',
+    'console-port-templates',
+    'power-outlet-templates',
+    'console-server-port-templates',
+    'rear-port-templates',
+    'front-port-templates',
+    'device-bay-templates',
+    'module-bay-templates',
+)
+ENDPOINTS = ('manufacturers', 'device-types', 'module-types') + TEMPLATE_ENDPOINTS
+
+# Foreign keys and the endpoint they point at
+FOREIGN_KEYS = {
+    'manufacturer': 'manufacturers',
+    'device_type': 'device-types',
+    'module_type': 'module-types',
+    'power_port': 'power-port-templates',
+    'rear_port': 'rear-port-templates',
+}
+CHOICE_FIELDS = ('type', 'feed_leg', 'poe_mode', 'poe_type', 'subdevice_role', 'airflow', 'weight_unit')
+IMAGE_FIELDS = ('front_image', 'rear_image')
+FILTERS = {
+    'devicetype_id': 'device_type',
+    'moduletype_id': 'module_type',
+    'manufacturer_id': 'manufacturer',
+}
+BRIEF_FIELDS = {
+    'manufacturers': ('id', 'url', 'display', 'name', 'slug'),
+    'device-types': ('id', 'url', 'display', 'manufacturer', 'model', 'slug'),
+    'module-types': ('id', 'url', 'display', 'manufacturer', 'model'),
+}
+MAX_PAGE_SIZE = 1000
+DEFAULT_PAGE_SIZE = 50
+
+
+class FakeNetBoxState:
+    '''Object store plus request accounting shared by all handler threads.'''
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.objects = {endpoint: {} for endpoint in ENDPOINTS}
+        self.next_id = Counter()
+        self.requests = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def reset_metrics(self):
+        with self.lock:
+            self.requests.clear()
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def record(self, method, endpoint, bytes_in, bytes_out):
+        with self.lock:
+            self.requests[(method, endpoint)] += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    @staticmethod
+    def now():
+        return datetime.now(timezone.utc).isoformat()
+
+
+class FakeNetBoxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle would delay every response
+    disable_nagle_algorithm = True
+    state: FakeNetBoxState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    # -- plumbing ----------------------------------------------------------
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, payload=None, endpoint='', body_len=0, headers=None):
+        data = b'' if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('API-Version', API_VERSION)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.state.record(self.command, endpoint, body_len, len(data))
+
+    def _route(self):
+        parts = urlsplit(self.path)
+        segments = [s for s in parts.path.split('/') if s]
+        query = parse_qs(parts.query)
+        if segments[:1] != ['api']:
+            return None, None, query
+        segments = segments[1:]
+        if segments and segments[0] == 'dcim':
+            segments = segments[1:]
+        endpoint = segments[0] if segments else ''
+        obj_id = int(segments[1]) if len(segments) > 1 and segments[1].isdigit() else None
+        return endpoint, obj_id, query
+
+    def _dispatch(self):
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        body = self._body()
+        if self.path.startswith('/media/'):
+            return self._media(len(body))
+        endpoint, obj_id, query = self._route()
+        if endpoint is None:
+            return self._send(404, {'detail': 'Not found.'}, body_len=len(body))
+        if endpoint == '':
+            return self._send(200, {'dcim': self._base_url() + '/api/dcim/'}, 'root', len(body))
+        if endpoint == 'status':
+            return self._send(200, {'netbox-version': API_VERSION + '.0'}, 'status', len(body))
+        if endpoint not in ENDPOINTS:
+            return self._send(404, {'detail': 'Not found.'}, endpoint, len(body))
+        handler = getattr(self, f'_{self.command.lower()}')
+        status, payload = handler(endpoint, obj_id, query, body)
+        return self._send(status, payload, endpoint, len(body))
+
+    do_GET = do_HEAD = do_POST = do_PATCH = do_DELETE = _dispatch
+
+    def _media(self, body_len):
+        '''Serve uploaded images as zero bytes of the uploaded size'''
+        name = self.path.rsplit('/', 1)[-1]
+        size = None
+        with self.state.lock:
+            for obj in self.state.objects['device-types'].values():
+                for field in IMAGE_FIELDS:
+                    if obj.get(field) and obj[field]['name'] == name:
+                        size = obj[field]['size']
+        data = b'' if size is None else bytes(size)
+        self.send_response(404 if size is None else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+        self.state.record(self.command, 'media', body_len, 0 if self.command == 'HEAD' else len(data))
+
+    def _base_url(self):
+        return f'http://{self.headers.get("Host")}'
+
+    # -- serialization -----------------------------------------------------
+
+    def _nested(self, endpoint, obj_id):
+        obj = self.state.objects[endpoint].get(obj_id)
+        if obj is None:
+            return None
+        nested = {'id': obj_id, 'url': f'{self._base_url()}/api/dcim/{endpoint}/{obj_id}/',
+                  'display': obj.get('name') or obj.get('model')}
+        for key in ('name', 'model', 'slug'):
+            if key in obj:
+                nested[key] = obj[key]
+        return nested
+
+    def _serialize(self, endpoint, obj, brief=False, fields=None):
+        data = {'id': obj['id'], 'url': f'{self._base_url()}/api/dcim/{endpoint}/{obj["id"]}/',
+                'display': obj.get('name') or obj.get('model')}
+        for key, value in obj.items():
+            if key in FOREIGN_KEYS:
+                value = self._nested(FOREIGN_KEYS[key], value) if value else None
+            elif key in CHOICE_FIELDS and value:
+                value = {'value': value, 'label': str(value).title()}
+            elif key in IMAGE_FIELDS:
+                value = f'{self._base_url()}/media/devicetype-images/{value["name"]}' if value else None
+            data[key] = value
+        if brief and endpoint in BRIEF_FIELDS:
+            data = {key: data[key] for key in BRIEF_FIELDS[endpoint] if key in data}
+        if fields:
+            data = {key: data[key] for key in fields if key in data}
+        return data
+
+    # -- validation --------------------------------------------------------
+
+    def _resolve_fk(self, field, value):
+        if isinstance(value, dict):
+            target = FOREIGN_KEYS[field]
+            for obj in self.state.objects[target].values():
+                if all(obj.get(k) == v for k, v in value.items()):
+                    return obj['id'], None
+            return None, [f'Related object not found using the provided attributes: {value}']
+        if value is None:
+            return None, None
+        if value not in self.state.objects[FOREIGN_KEYS[field]]:
+            return None, [f'Invalid pk "{value}" - object does not exist.']
+        return value, None
+
+    def _validate(self, endpoint, row, pending, existing=None):
+        errors = {}
+        obj = dict(existing or {})
+        for key, value in row.items():
+            if key == 'id':
+                continue
+            if key in FOREIGN_KEYS:
+                value, error = self._resolve_fk(key, value)
+                if error:
+                    errors[key] = error
+                    continue
+            obj[key] = value
+        if endpoint == 'manufacturers':
+            required = ('name', 'slug')
+            unique = (('name',), ('slug',))
+        elif endpoint in ('device-types', 'module-types'):
+            required = ('manufacturer', 'model') + (('slug',) if endpoint == 'device-types' else ())
+            unique = (('manufacturer', 'model'),)
+        else:
+            required = ('name',)
+            unique = (('device_type', 'module_type', 'name'),)
+            if not obj.get('device_type') and not obj.get('module_type'):
+                errors.setdefault('__all__', []).append('A component template must be assigned to either a device type or a module type.')
+            if endpoint == 'front-port-templates' and not obj.get('rear_port'):
+                errors.setdefault('rear_port', []).append('This field is required.')
+        for key in required:
+            if not obj.get(key):
+                errors.setdefault(key, []).append('This field is required.')
+        others = list(self.state.objects[endpoint].values()) + pending
+        for fields in unique:
+            key = tuple(obj.get(f) for f in fields)
+            for other in others:
+                if (obj.get('id') is None or other.get('id') != obj.get('id')) and tuple(other.get(f) for f in fields) == key:
+                    errors.setdefault('__all__', []).append(f'{fields} must be unique.')
+                    break
+        return obj, errors
+
+    # -- verbs -------------------------------------------------------------
+
+    def _get(self, endpoint, obj_id, query, body):
+        store = self.state.objects[endpoint]
+        if obj_id is not None:
+            if obj_id not in store:
+                return 404, {'detail': 'Not found.'}
+            return 200, self._serialize(endpoint, store[obj_id])
+        brief = query.get('brief', ['false'])[0].lower() in ('1', 'true')
+        fields = query['fields'][0].split(',') if 'fields' in query else None
+        items = list(store.values())
+        for param, values in query.items():
+            if param in ('limit', 'offset', 'brief', 'fields'):
+                continue
+            if param == 'last_updated__gte':
+                items = [o for o in items if o['last_updated'] >= values[0]]
+                continue
+            field = FILTERS.get(param, param)
+            wanted = set(values)
+            items = [o for o in items if str(o.get(field)) in wanted]
+        limit = int(query.get('limit', [DEFAULT_PAGE_SIZE])[0]) or DEFAULT_PAGE_SIZE
+        limit = min(limit, MAX_PAGE_SIZE)
+        offset = int(query.get('offset', [0])[0])
+        page = items[offset:offset + limit]
+        next_url = None
+        if offset + limit < len(items):
+            params = '&'.join(f'{k}={v}' for k, vs in query.items() if k not in ('limit', 'offset') for v in vs)
+            next_url = (f'{self._base_url()}/api/dcim/{endpoint}/?{params}&limit={limit}'
+                        f'&offset={offset + limit}')
+        return 200, {'count': len(items), 'next': next_url, 'previous': None,
+                     'results': [self._serialize(endpoint, o, brief, fields) for o in page]}
+
+    def _post(self, endpoint, obj_id, query, body):
+        data = json.loads(body or b'{}')
+        rows = data if isinstance(data, list) else [data]
+        with self.state.lock:
+            pending, errors = [], []
+            for row in rows:
+                obj, error = self._validate(endpoint, row, pending)
+                pending.append(obj)
+                errors.append(error)
+            if any(errors):
+                return 400, errors if isinstance(data, list) else errors[0]
+            created = []
+            for obj in pending:
+                self.state.next_id[endpoint] += 1
+                obj['id'] = self.state.next_id[endpoint]
+                obj['last_updated'] = self.state.now()
+                if endpoint == 'device-types':
+                    for image in IMAGE_FIELDS:
+                        obj.setdefault(image, None)
+                self.state.objects[endpoint][obj['id']] = obj
+                created.append(obj)
+        result = [self._serialize(endpoint, o) for o in created]
+        return 201, result if isinstance(data, list) else result[0]
+
+    def _patch(self, endpoint, obj_id, query, body):
+        store = self.state.objects[endpoint]
+        if self.headers.get('Content-Type', '').startswith('multipart/form-data'):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode() + body)
+            data = {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True)
+                data[name] = {'name': part.get_filename(), 'size': len(payload)}
+        else:
+            data = json.loads(body or b'{}')
+        rows = data if isinstance(data, list) else [dict(data, id=obj_id)]
+        with self.state.lock:
+            updated, errors = [], []
+            for row in rows:
+                if row.get('id') not in store:
+                    return 404, {'detail': 'Not found.'}
+                obj, error = self._validate(endpoint, row, [], existing=store[row['id']])
+                updated.append(obj)
+                errors.append(error)
+            if any(errors):
+                return 400, errors if isinstance(data, list) else errors[0]
+            for obj in updated:
+                obj['last_updated'] = self.state.now()
+                store[obj['id']] = obj
+        result = [self._serialize(endpoint, o) for o in updated]
+        return 200, result if isinstance(data, list) else result[0]
+
+    def _delete(self, endpoint, obj_id, query, body):
+        with self.state.lock:
+            if self.state.objects[endpoint].pop(obj_id, None) is None:
+                return 404, {'detail': 'Not found.'}
+        return 204, None
+
+
+class FakeNetBox:
+    '''Run a FakeNetBoxState behind a local HTTP server thread.
+
+    >>> with FakeNetBox(latency=0.01) as netbox:
+    ...     api = pynetbox.api(netbox.url, token='0123456789abcdef')
+    '''
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0):
+        self.state = FakeNetBoxState(latency)
+        handler = type('Handler', (FakeNetBoxHandler,), {'state': self.state})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,190 @@
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from urllib.parse import parse_qs, urlsplit
+import json
+import threading
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    '''Serve /health, /stats and POST /sync of the SyncDaemon of the server'''
+
+    def log_message(self, format, *args):
+        self.server.sync_daemon.handle.verbose_log(f'HTTP {format}', *args)
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        sync_daemon = self.server.sync_daemon
+        path = urlsplit(self.path).path
+        if path == '/health':
+            healthy, health = sync_daemon.get_health()
+            return self.send_json(200 if healthy else 503, health)
+        if path == '/stats':
+            return self.send_json(200, sync_daemon.get_stats())
+        self.send_json(404, {'detail': 'Not found.'})
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        if parts.path != '/sync':
+            return self.send_json(404, {'detail': 'Not found.'})
+        full = parse_qs(parts.query).get('full', ['0'])[0].lower() in ('1', 'true')
+        self.server.sync_daemon.trigger(full)
+        self.send_json(202, {'status': 'queued', 'full': full})
+
+
+class SyncDaemon:
+    '''Keep importing the library into NetBox as it changes
+
+    The NetBox connections, their remote state and sync manifests, the
+    repository index and the parse cache stay in memory between syncs.
+    Every interval the library is pulled, and if HEAD moved, or the last
+    sync did not import everything, the changes are imported. A sync can
+    also be requested through POST /sync.
+    '''
+
+    def __new__(cls, *args, **kwargs):
+        return super().__new__(cls)
+
+    def __init__(self, sync, targets, dtl_repo, handle, metrics, interval=60, listen=None, full=False, resume=False):
+        '''
+        Args:
+        sync: function(targets, full, resume) importing the changes, returns the number of failed targets
+        targets: the targets passed to sync, each with its connected NetBox
+        metrics: Metrics whose phase timings are restarted for every sync
+        listen: HOST:PORT to serve the status endpoints on, None for none
+        full: check every definition in the first sync
+        resume: resume the journaled import of an earlier run first
+        '''
+        self.sync = sync
+        self.targets = targets
+        self.dtl_repo = dtl_repo
+        self.handle = handle
+        self.interval = interval
+        self.listen = listen
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.started = datetime.now(timezone.utc)
+        # Requested through POST /sync
+        self.requested = False
+        self.requested_full = full
+        # A sync that failed halfway is resumed from its journal
+        self.resume = resume
+        # Until a sync imported everything, the next poll syncs even if HEAD did not move
+        self.pending = True
+        # HEAD of the last poll, and as of the last sync that imported everything
+        self.commit = dtl_repo.get_head_commit()
+        self.synced_commit = None
+        self.syncs = 0
+        self.failed_syncs = 0
+        self.running = False
+        self.last_sync = None
+        self.server = None
+
+    def serve(self):
+        host, port = self.listen.rsplit(':', 1)
+        self.server = ThreadingHTTPServer((host, int(port)), StatusHandler)
+        self.server.daemon_threads = True
+        self.server.sync_daemon = self
+        threading.Thread(target=self.server.serve_forever, name='status-server', daemon=True).start()
+        self.handle.log(f'Serving /health, /stats and POST /sync on {self.listen}')
+
+    def trigger(self, full=False):
+        '''Run a sync now, or right after the running one'''
+        with self.lock:
+            self.requested = True
+            self.requested_full = self.requested_full or full
+        self.wake.set()
+
+    def get_health(self):
+        '''Return (healthy, details), unhealthy while the last sync failed'''
+        with self.lock:
+            last_sync = self.last_sync
+        healthy = last_sync is None or last_sync['succeeded']
+        return healthy, {'status': 'ok' if healthy else 'failing', 'commit': self.commit,
+                         'last_sync': last_sync and last_sync['finished']}
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'started': self.started.isoformat(),
+                'uptime': round((datetime.now(timezone.utc) - self.started).total_seconds(), 3),
+                'interval': self.interval,
+                'running': self.running,
+                'commit': self.commit,
+                'synced_commit': self.synced_commit,
+                'syncs': self.syncs,
+                'failed_syncs': self.failed_syncs,
+                'last_sync': self.last_sync,
+            }
+
+    def run(self):
+        if self.listen:
+            self.serve()
+        self.handle.log(f'Daemon mode, polling the library every {self.interval:g}s')
+        while True:
+            self.wake.clear()
+            with self.lock:
+                requested, full = self.requested, self.requested_full
+                self.requested = self.requested_full = False
+            self.run_sync(requested, full)
+            self.wake.wait(self.interval)
+
+    def run_sync(self, requested=False, full=False):
+        '''Pull the library and import its changes, a failure is recorded and retried on the next poll'''
+        self.metrics.start_run()
+        started = datetime.now(timezone.utc)
+        start = monotonic()
+        failed, error, commit = len(self.targets), None, self.commit
+        try:
+            with self.metrics.phase('git'):
+                changed = self.dtl_repo.update()
+            commit = self.commit = self.dtl_repo.get_head_commit()
+            if not requested and not changed and not self.pending:
+                self.handle.verbose_log('Library unchanged, nothing to import')
+                return
+            with self.lock:
+                self.running = True
+            failed = self.sync(self.targets, full, self.resume)
+        except SystemExit:
+            # handle.exception() logged the error before exiting
+            error = 'Sync failed, see the log'
+        except Exception as sync_error:
+            error = str(sync_error)
+            self.handle.log(f'Sync failed: {sync_error}')
+
+        targets = {}
+        for target in self.targets:
+            netbox = target.get('netbox')
+            counter = dict(getattr(netbox, 'counter', {}))
+            if error is None and hasattr(netbox, 'device_types'):
+                counter['failed_files'] = len(netbox.get_failed_sources())
+            targets[target['url']] = counter
+        succeeded = error is None and not failed and not any(
+            counter.get('failed_files') for counter in targets.values())
+        with self.lock:
+            self.running = False
+            self.syncs += 1
+            self.failed_syncs += not succeeded
+            self.resume = error is not None or bool(failed)
+            self.pending = not succeeded
+            if succeeded:
+                self.synced_commit = commit
+            self.last_sync = {
+                'started': started.isoformat(),
+                'finished': datetime.now(timezone.utc).isoformat(),
+                'seconds': round(monotonic() - start, 3),
+                'commit': commit,
+                'full': full,
+                'succeeded': succeeded,
+                'failed_targets': failed,
+                'error': error,
+                'targets': targets,
+            }
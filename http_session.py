@@ -0,0 +1,254 @@
+from time import monotonic, sleep
+import io
+import mimetypes
+import os
+import threading
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InvalidHeader
+from urllib3.util.retry import Retry
+
+
+# Responses that tell the client to back off. POST is only repeated after a
+# 429, which NetBox sends before doing any work: a bulk create answered
+# with a 5xx may already have been processed.
+BACKOFF_STATUS = (429, 502, 503, 504)
+
+
+class Scheduler:
+    '''Paces the requests of one session against NetBox
+
+    Requests are started at most rate per second (token bucket, 0 for no
+    limit) and at most limit at a time. The limit adapts to how NetBox
+    copes (AIMD): it grows by one per limit requests that succeed, and
+    halves, at most once per round of requests in flight, on a 429 or 5xx
+    answer or a response slower than max_latency. A Retry-After header
+    pauses every request until it has passed.
+    '''
+
+    def __new__(cls, *args, **kwargs):
+        return super().__new__(cls)
+
+    def __init__(self, rate=0, max_in_flight=10, max_latency=0, handle=None):
+        self.rate = rate
+        self.max_in_flight = max(max_in_flight, 1)
+        self.max_latency = max_latency
+        self.handle = handle
+        self.limit = float(self.max_in_flight)
+        self.in_flight = 0
+        self.tokens = 1.0
+        self.burst = max(rate, 1.0)
+        self.refilled = monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        self.stats = {'throttled': 0, 'paused': 0, 'lowest_limit': self.max_in_flight}
+
+    def acquire(self):
+        '''Wait until a request may start
+
+        Returns:
+        monotonic start time, to be handed to release()
+        '''
+        with self.condition:
+            while True:
+                now = monotonic()
+                wait = self.paused_until - now
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    if not self.rate:
+                        break
+                    self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                    self.refilled = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    wait = (1 - self.tokens) / self.rate
+                # Woken early when a request finishes, the limit grows or a pause is set
+                self.condition.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+        return now
+
+    def release(self, started, status=None):
+        '''Account a finished request, status is None if it failed without a response'''
+        latency = monotonic() - started
+        with self.condition:
+            self.in_flight -= 1
+            if status in BACKOFF_STATUS or (self.max_latency and latency > self.max_latency):
+                # Requests that were already in flight report the same overload, count it once
+                if started >= self.last_decrease and self.limit > 1:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = monotonic()
+                    self.stats['throttled'] += 1
+                    self.stats['lowest_limit'] = min(self.stats['lowest_limit'], int(self.limit))
+                    if self.handle:
+                        self.handle.verbose_log('NetBox is overloaded (%s after %.2fs), at most %d requests in flight',
+                                                status, latency, int(self.limit))
+            elif status is not None and status < 500:
+                self.limit = min(float(self.max_in_flight), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        '''Hold back every request for seconds, as asked by a Retry-After header'''
+        with self.condition:
+            until = monotonic() + seconds
+            if until > self.paused_until:
+                self.paused_until = until
+                self.stats['paused'] += 1
+                if self.handle:
+                    self.handle.verbose_log('NetBox asked to retry after %.1fs, pausing all requests', seconds)
+            self.condition.notify_all()
+
+
+class ScheduledAdapter(HTTPAdapter):
+    '''HTTPAdapter that sends every request through a Scheduler
+
+    Answers in BACKOFF_STATUS are retried here rather than by urllib3, so
+    each attempt waits for the scheduler and a Retry-After pauses every
+    request, not just the one that got it.
+    '''
+
+    def __init__(self, scheduler, retries=5, backoff_factor=0.5, **kwargs):
+        self.scheduler = scheduler
+        self.status_retries = retries
+        self.backoff_factor = backoff_factor
+        super().__init__(**kwargs)
+
+    def get_retry_after(self, response):
+        '''Return the seconds of the Retry-After header of response, or None'''
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return self.max_retries.parse_retry_after(value)
+        except InvalidHeader:
+            return None
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            started = self.scheduler.acquire()
+            status = None
+            try:
+                response = super().send(request, **kwargs)
+                status = response.status_code
+            finally:
+                self.scheduler.release(started, status)
+
+            if status not in BACKOFF_STATUS or attempt >= self.status_retries \
+                    or (request.method == 'POST' and status != 429):
+                return response
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None:
+                self.scheduler.pause(retry_after)
+            else:
+                sleep(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+            response.close()
+            # Streamed bodies such as MultipartStream are sent again from the start
+            if hasattr(request.body, 'seek'):
+                request.body.seek(0)
+
+
+def build_session(pool_size=10, retries=5, backoff_factor=0.5, verify=True, scheduler=None):
+    '''Return the keep-alive session shared by pynetbox and the image uploads
+
+    Args:
+    pool_size: connections kept open per host, should match the concurrency
+    retries: attempts on connection errors and 429/502/503/504 responses
+    backoff_factor: base of the exponential delay between attempts, in seconds
+    verify: False to skip TLS certificate verification
+    scheduler: Scheduler pacing the requests, by default one without a rate limit
+
+    Returns:
+    requests.Session
+    '''
+    # Only connection and read errors are retried by urllib3, the adapter retries on status
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=0,
+        backoff_factor=backoff_factor,
+        allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'PATCH', 'DELETE']),
+        raise_on_status=False,
+    )
+    adapter = ScheduledAdapter(scheduler or Scheduler(max_in_flight=pool_size), retries, backoff_factor,
+                               pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.verify = verify
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class MultipartStream:
+    '''multipart/form-data body that reads its files from disk while it is sent
+
+    requests builds multipart bodies in memory, this keeps only one chunk of
+    the images in memory at a time. The length is known upfront so NetBox
+    gets a Content-Length header, and seek(0) lets urllib3 rewind on retries.
+    '''
+
+    def __init__(self, files: dict):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self.parts = []
+        for field, path in files.items():
+            mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            self.parts.append((f'--{self.boundary}\r\n'
+                               + f'Content-Disposition: form-data; name="{field}"; '
+                               + f'filename="{os.path.basename(path)}"\r\n'
+                               + f'Content-Type: {mimetype}\r\n\r\n').encode())
+            self.parts.append(path)
+            self.parts.append(b'\r\n')
+        self.parts.append(f'--{self.boundary}--\r\n'.encode())
+        self.len = sum(len(part) if isinstance(part, bytes) else os.path.getsize(part)
+                       for part in self.parts)
+        self.stream = None
+        self.seek(0)
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise OSError('MultipartStream can only be rewound to the start')
+        self.close()
+        self.position = 0
+        self.remaining = iter(self.parts)
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        chunks = []
+        wanted = self.len if size is None or size < 0 else size
+        while wanted > 0:
+            if self.stream is None:
+                part = next(self.remaining, None)
+                if part is None:
+                    break
+                self.stream = open(part, 'rb') if isinstance(part, str) else io.BytesIO(part)
+            chunk = self.stream.read(wanted)
+            if not chunk:
+                self.stream.close()
+                self.stream = None
+                continue
+            chunks.append(chunk)
+            wanted -= len(chunk)
+        data = b''.join(chunks)
+        self.position += len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(64 * 1024)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
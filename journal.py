@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import threading
+
+
+class Journal:
+    '''Append-only record of the progress of an import into one NetBox
+
+    A device or module type is written once NetBox has it, with its id, and
+    again once all of its component templates were written. Every batch of
+    templates NetBox accepted is written with the ids it got. Each line is
+    flushed as it is written, so when a run dies the journal still holds
+    everything that finished before. A run with --resume skips the types
+    the journal has as complete and reuses the ids of the others.
+    '''
+
+    def __new__(cls, *args, **kwargs):
+        return super().__new__(cls)
+
+    def __init__(self, path, target, handle, resume=False):
+        self.path = path
+        self.target = target
+        self.handle = handle
+        self.lock = threading.Lock()
+        # {kind: {key: [digest, object id, complete]}}
+        self.types = {'device-types': {}, 'module-types': {}}
+        self.templates = 0
+        self.stream = None
+        if resume:
+            self.load()
+        self.open(append=resume)
+
+    @staticmethod
+    def get_path(cache_path, target):
+        '''Return the journal file of one NetBox below cache_path, or None without a cache'''
+        if not cache_path:
+            return None
+        return os.path.join(cache_path, 'journal', f'{hashlib.sha256(target.encode()).hexdigest()[:16]}.jsonl')
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            self.handle.log('Nothing to resume, no journal of an earlier run')
+            return
+        with open(self.path, 'r') as stream:
+            for line in stream:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of a run that died while writing it
+                    continue
+                if entry.get('event') == 'type':
+                    self.types[entry['kind']][entry['key']] = [entry['digest'], entry['id'], entry['complete']]
+                elif entry.get('event') == 'batch':
+                    self.templates += len(entry['ids'])
+        complete = sum(entry[2] for entries in self.types.values() for entry in entries.values())
+        total = sum(len(entries) for entries in self.types.values())
+        self.handle.log(f'Resuming: {complete} types complete, {total - complete} incomplete, '
+                        + f'{self.templates} component templates written')
+
+    def open(self, append=False):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.stream = open(self.path, 'a' if append else 'w')
+        if not append:
+            self.write({'event': 'start', 'target': self.target})
+
+    def write(self, entry):
+        if self.stream is None:
+            return
+        line = json.dumps(entry, separators=(',', ':'))
+        with self.lock:
+            self.stream.write(f'{line}\n')
+            self.stream.flush()
+
+    def record_type(self, kind, key, digest, object_id, complete=False):
+        self.types[kind][key] = [digest, object_id, complete]
+        self.write({'event': 'type', 'kind': kind, 'key': key, 'digest': digest, 'id': object_id,
+                    'complete': complete})
+
+    def record_batch(self, endpoint, items):
+        '''Record the templates NetBox created or updated in one request
+
+        Args:
+        endpoint: API endpoint the batch was sent to
+        items: [(parent type, parent id, name, template id)]
+        '''
+        self.write({'event': 'batch', 'endpoint': endpoint, 'ids': items})
+
+    def is_complete(self, kind, key, digest):
+        entry = self.types[kind].get(key)
+        return entry is not None and entry[0] == digest and entry[2]
+
+    def get_id(self, kind, key):
+        entry = self.types[kind].get(key)
+        return entry[1] if entry else None
+
+    def get_ids(self, kind):
+        '''Return {key: object id} of the journaled types of one kind'''
+        return {key: entry[1] for key, entry in self.types[kind].items()}
+
+    def close(self):
+        '''Stop writing, the journal stays for a later run to resume from'''
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+    def finish(self):
+        '''Remove the journal of a run that finished, there is nothing left to resume'''
+        if self.stream is None:
+            return
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
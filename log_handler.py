@@ -1,12 +1,165 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from sys import exit as system_exit
+from time import monotonic
+import atexit
+import copy
+import json
+import queue
+import sys
+import threading
+
+DEBUG = 10
+INFO = 20
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', ERROR: 'error'}
 
 
 class LogHandler:
+    '''Levelled log output written by a background thread
+
+    Messages are only formatted when their level is enabled: pass the
+    arguments separately, as in verbose_log('Created %s', name). Lines are
+    handed to a writer thread that writes whatever has queued up in one go,
+    so callers never wait for the console. With --log-format json every
+    line is a JSON object with time, level, message and any extra fields.
+    '''
+
     def __new__(cls, *args, **kwargs):
         return super().__new__(cls)
 
     def __init__(self, args):
         self.args = args
+        self.level = DEBUG if args.verbose else INFO
+        self.json = getattr(args, 'log_format', 'text') == 'json'
+        # Name of the NetBox the lines are about, when importing into several
+        self.target = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.progress_interval = 0.5
+        self.progress_shown = 0.0
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.run_writer, name='log-writer', daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def run_writer(self):
+        progress = None
+        while True:
+            items = [self.queue.get()]
+            # Write everything that queued up meanwhile with a single call
+            while len(items) < 1000:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines, flushed, stop = [], [], False
+            previous_progress = progress
+            for item in items:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    flushed.append(item)
+                elif isinstance(item, tuple):
+                    progress = item[1]
+                else:
+                    lines.extend(item)
+
+            stream = sys.stdout
+            output = ''
+            if previous_progress and (lines or progress != previous_progress):
+                output += '\r\033[K'
+            output += ''.join(f'{line}\n' for line in lines)
+            if progress and (lines or progress != previous_progress):
+                output += progress
+            if output:
+                try:
+                    stream.write(output)
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass
+            for event in flushed:
+                event.set()
+            if stop:
+                return
+
+    def flush(self):
+        '''Wait until every queued line has been written'''
+        if not self.writer.is_alive():
+            return
+        written = threading.Event()
+        self.queue.put(written)
+        written.wait()
+
+    def child(self, target):
+        '''Return a handler that writes through this one, marking every line with target'''
+        child = copy.copy(self)
+        child.target = target
+        return child
+
+    def close(self):
+        if self.writer.is_alive():
+            self.progress(None)
+            self.queue.put(None)
+            self.writer.join()
+
+    def format(self, level, message, args, fields=None):
+        if args:
+            message = message % args
+        if not self.json:
+            return f'[{self.target}] {message}' if self.target else message
+        record = {'time': datetime.now(timezone.utc).isoformat(), 'level': LEVEL_NAMES[level], 'message': message}
+        if self.target:
+            record['target'] = self.target
+        record.update(fields or {})
+        return json.dumps(record, default=str)
+
+    @contextmanager
+    def buffered(self):
+        '''Hold back this thread's output and write it as one block on exit'''
+        self.local.buffer = []
+        try:
+            yield
+        finally:
+            buffer, self.local.buffer = self.local.buffer, None
+            if buffer:
+                self.queue.put(buffer)
+
+    def write(self, level, message, *args, fields=None):
+        if level < self.level:
+            return
+        line = self.format(level, message, args, fields)
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is not None:
+            buffer.append(line)
+            return
+        self.queue.put([line])
+
+    def progress(self, label, done=0, total=None):
+        '''Show "label: done/total" on one updating console line, None clears it
+
+        Without a total only the count is shown, e.g. while the items are
+        still being read. Only shown on an interactive console with text
+        output, and redrawn at most every progress_interval seconds.
+        '''
+        if label is None:
+            self.queue.put(('progress', None))
+            return
+        if self.json or not sys.stdout.isatty():
+            return
+        finished = total is not None and done >= total
+        now = monotonic()
+        with self.lock:
+            if not finished and now - self.progress_shown < self.progress_interval:
+                return
+            self.progress_shown = now
+        if finished:
+            self.queue.put(('progress', None))
+        else:
+            if self.target:
+                label = f'[{self.target}] {label}'
+            self.queue.put(('progress', f'{label}: {done}' if total is None else f'{label}: {done}/{total}'))
 
     def exception(self, exception_type, exception, stack_trace=None):
         exception_dict = {
@@ -17,28 +170,39 @@ class LogHandler:
             "Exception": f'An unknown error occurred: "{exception}"'
         }
 
-        if self.args.verbose and stack_trace:
-            print(stack_trace)
-        print(exception_dict[exception_type])
+        buffer, self.local.buffer = getattr(self.local, 'buffer', None), None
+        if buffer:
+            self.queue.put(buffer)
+        if stack_trace:
+            self.write(DEBUG, '%s', stack_trace)
+        self.write(ERROR, exception_dict[exception_type], fields={'error': exception_type})
+        # Only ends the import into this target, the others go on writing through the same thread
+        if self.target is None:
+            self.close()
         system_exit(1)
 
-    def verbose_log(self, message):
-        if self.args.verbose:
-            print(message)
+    def verbose_log(self, message, *args, **fields):
+        self.write(DEBUG, message, *args, fields=fields)
+
+    def log(self, message, *args, **fields):
+        self.write(INFO, message, *args, fields=fields)
 
-    def log(self, message):
-        print(message)
+    def log_ports(self, ports, port_type, action, parent_type):
+        if self.level > DEBUG:
+            return
+        for port in ports:
+            # vars() avoids pynetbox fetching the full record for fields it does not have
+            record = vars(port)
+            self.verbose_log('%s Template %s: %s - %s - %s - %s', port_type, action, record['name'],
+                             record.get('type') or '', record[parent_type].id, record['id'],
+                             event='template', action=action.lower(), port_type=port_type,
+                             name=record['name'], parent_type=parent_type,
+                             parent_id=record[parent_type].id, id=record['id'])
 
-    def log_device_ports_created(self, created_ports: list = [], port_type: str = "port"):
-        for port in created_ports:
-            self.verbose_log(f'{port_type} Template Created: {port.name} - '
-                             + f'{port.type if hasattr(port, "type") else ""} - {port.device_type.id} - '
-                             + f'{port.id}')
+    def log_device_ports_created(self, created_ports: list = [], port_type: str = "port", action: str = "Created"):
+        self.log_ports(created_ports, port_type, action, 'device_type')
         return len(created_ports)
 
-    def log_module_ports_created(self, created_ports: list = [], port_type: str = "port"):
-        for port in created_ports:
-            self.verbose_log(f'{port_type} Template Created: {port.name} - '
-                             + f'{port.type if hasattr(port, "type") else ""} - {port.module_type.id} - '
-                             + f'{port.id}')
+    def log_module_ports_created(self, created_ports: list = [], port_type: str = "port", action: str = "Created"):
+        self.log_ports(created_ports, port_type, action, 'module_type')
         return len(created_ports)
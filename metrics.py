@@ -0,0 +1,257 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import perf_counter
+from urllib.parse import urlsplit
+import cProfile
+import io
+import json
+import pstats
+import threading
+
+from atomic_file import write_atomically
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ('git', 'connect', 'discovery', 'parse', 'manufacturers', 'device-types', 'images', 'module-types')
+
+
+def get_endpoint(url):
+    '''Reduce a request URL to the endpoint it addresses, e.g. dcim/interface-templates'''
+    path = urlsplit(url).path
+    if '/media/' in path:
+        return 'media'
+    segments = [segment for segment in path.split('/api/', 1)[-1].split('/')
+                if segment and not segment.isdigit()]
+    return '/'.join(segments) or 'root'
+
+
+def get_body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    # Streamed bodies such as MultipartStream know their length upfront
+    return getattr(body, 'len', 0)
+
+
+class Metrics:
+    '''HTTP request and phase timings of one import run
+
+    Every response of the shared session is recorded per method and
+    endpoint: count, status codes, bytes sent and received and a latency
+    histogram. Retried requests are seen once, with the status and latency
+    of the last attempt.
+    '''
+
+    def __new__(cls, *args, **kwargs):
+        return super().__new__(cls)
+
+    def __init__(self, handle, profile=None, name=None):
+        '''
+        Args:
+        profile: phase to run under cProfile, see --profile
+        name: of the NetBox of target metrics, added to the file name of the profile
+        '''
+        self.handle = handle
+        self.profile = profile
+        self.name = name
+        self.profiler = None
+        self.lock = threading.Lock()
+        self.started = datetime.now(timezone.utc)
+        self.phases = {}
+        self.requests = {}
+        # {NetBox URL: Metrics} when importing into several NetBox instances
+        self.targets = {}
+
+    def for_target(self, url, handle):
+        '''Return the metrics of the import into one of several NetBox instances, logged to handle'''
+        with self.lock:
+            if url not in self.targets:
+                self.targets[url] = Metrics(handle, self.profile, urlsplit(url).netloc or url)
+            return self.targets[url]
+
+    def start_run(self):
+        '''Start timing the next run, e.g. the next sync of --daemon
+
+        The request counters keep counting from the start of the process,
+        as Prometheus expects of counters.
+        '''
+        with self.lock:
+            self.started = datetime.now(timezone.utc)
+            self.phases = {}
+            targets = list(self.targets.values())
+        for metrics in targets:
+            metrics.start_run()
+
+    def attach(self, session):
+        '''Record every response of a requests session'''
+        session.hooks['response'].append(self.record_response)
+
+    def record_response(self, response, *args, **kwargs):
+        request = response.request
+        latency = response.elapsed.total_seconds()
+        if 'Content-Length' in response.headers:
+            received = int(response.headers['Content-Length'])
+        else:
+            received = len(response.content or b'')
+        key = (request.method, get_endpoint(request.url))
+        with self.lock:
+            stats = self.requests.get(key)
+            if stats is None:
+                stats = self.requests[key] = {
+                    'count': 0, 'seconds': 0.0, 'bytes_sent': 0, 'bytes_received': 0,
+                    'status': {}, 'buckets': [0] * len(LATENCY_BUCKETS)}
+            stats['count'] += 1
+            stats['seconds'] += latency
+            stats['bytes_sent'] += get_body_size(request.body)
+            stats['bytes_received'] += received
+            status = str(response.status_code)
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats['buckets'][index] += 1
+                    break
+
+    @contextmanager
+    def phase(self, name):
+        '''Time a phase of the run, profiling it if it was selected with --profile
+
+        cProfile only sees the thread the phase runs on, not the --workers
+        threads it hands API calls to.
+        '''
+        profiling = name == self.profile
+        if profiling:
+            # A phase can run more than once, e.g. parse for device and module types
+            self.profiler = self.profiler or cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Python 3.12+ runs one profiler at a time, e.g. while the phase of another NetBox is profiled
+                profiling = False
+                self.handle.log(f'Not profiling this run of phase {name}, another profiler is active')
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            if profiling:
+                self.profiler.disable()
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + perf_counter() - start
+
+    def timed(self, name, iterable):
+        '''Yield from iterable, timing the work of every step as phase name
+
+        Used for a generator that is consumed by a later phase, e.g. parsing
+        feeding the API writes, so the time of each phase stays its own.
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def log_profile(self):
+        if self.profiler is None:
+            return
+        suffix = f"-{self.name.replace(':', '-')}" if self.name else ''
+        stats_file = f'nb-dt-import-{self.profile}{suffix}.prof'
+        self.profiler.dump_stats(stats_file)
+        output = io.StringIO()
+        pstats.Stats(self.profiler, stream=output).sort_stats('cumulative').print_stats(25)
+        self.handle.log(f'Profile of phase {self.profile}, full statistics saved to {stats_file}:')
+        self.handle.log(output.getvalue())
+
+    def log_summary(self):
+        self.log_profile()
+        for name, seconds in self.phases.items():
+            self.handle.verbose_log('Phase %s took %.3fs', name, seconds)
+        for (method, endpoint), stats in sorted(self.requests.items()):
+            self.handle.verbose_log('%s %s %s requests, %.1fms average', stats['count'], method, endpoint,
+                                    stats['seconds'] / stats['count'] * 1000)
+
+    def get_report(self):
+        with self.lock:
+            report = {
+                'started': self.started.isoformat(),
+                'phases': {name: round(seconds, 6) for name, seconds in self.phases.items()},
+                'requests': [dict(stats, method=method, endpoint=endpoint,
+                                  seconds=round(stats['seconds'], 6),
+                                  buckets=dict(zip([str(bound) for bound in LATENCY_BUCKETS], stats['buckets'])))
+                             for (method, endpoint), stats in sorted(self.requests.items())],
+            }
+            targets = dict(self.targets)
+        if targets:
+            report['targets'] = {url: metrics.get_report() for url, metrics in targets.items()}
+        return report
+
+    def get_prometheus(self):
+        '''Return the metrics in the Prometheus text exposition format
+
+        With several NetBox instances, phases and requests of each are
+        labelled with its URL.
+        '''
+        sources = [('', self)] + [(f'target="{url}",', metrics) for url, metrics in self.targets.items()]
+        lines = [
+            '# HELP nb_dt_import_last_run_timestamp_seconds Start of the last import run.',
+            '# TYPE nb_dt_import_last_run_timestamp_seconds gauge',
+            f'nb_dt_import_last_run_timestamp_seconds {self.started.timestamp():.3f}',
+            '# HELP nb_dt_import_phase_seconds Time spent in each phase of the last import run.',
+            '# TYPE nb_dt_import_phase_seconds gauge',
+        ]
+        for target, metrics in sources:
+            with metrics.lock:
+                for name, seconds in metrics.phases.items():
+                    lines.append(f'nb_dt_import_phase_seconds{{{target}phase="{name}"}} {seconds:.6f}')
+
+        lines.extend([
+            '# HELP nb_dt_import_http_requests_total HTTP requests sent to NetBox.',
+            '# TYPE nb_dt_import_http_requests_total counter',
+        ])
+        for target, metrics in sources:
+            with metrics.lock:
+                for (method, endpoint), stats in sorted(metrics.requests.items()):
+                    for status, count in sorted(stats['status'].items()):
+                        lines.append(f'nb_dt_import_http_requests_total{{{target}method="{method}",'
+                                     + f'endpoint="{endpoint}",status="{status}"}} {count}')
+
+        for direction in ('sent', 'received'):
+            lines.extend([
+                f'# HELP nb_dt_import_http_bytes_{direction}_total HTTP body bytes {direction}.',
+                f'# TYPE nb_dt_import_http_bytes_{direction}_total counter',
+            ])
+            for target, metrics in sources:
+                with metrics.lock:
+                    for (method, endpoint), stats in sorted(metrics.requests.items()):
+                        lines.append(f'nb_dt_import_http_bytes_{direction}_total{{{target}method="{method}",'
+                                     + f'endpoint="{endpoint}"}} {stats[f"bytes_{direction}"]}')
+
+        lines.extend([
+            '# HELP nb_dt_import_http_request_duration_seconds Time until NetBox sent the response headers.',
+            '# TYPE nb_dt_import_http_request_duration_seconds histogram',
+        ])
+        for target, metrics in sources:
+            with metrics.lock:
+                for (method, endpoint), stats in sorted(metrics.requests.items()):
+                    labels = f'{target}method="{method}",endpoint="{endpoint}"'
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+                        cumulative += count
+                        lines.append(f'nb_dt_import_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} '
+                                     + f'{cumulative}')
+                    lines.append(f'nb_dt_import_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} '
+                                 + f'{stats["count"]}')
+                    lines.append(f'nb_dt_import_http_request_duration_seconds_sum{{{labels}}} '
+                                 + f'{stats["seconds"]:.6f}')
+                    lines.append(f'nb_dt_import_http_request_duration_seconds_count{{{labels}}} {stats["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def save(self, report_file=None, prometheus_file=None):
+        if report_file:
+            report = self.get_report()
+            write_atomically(report_file, lambda stream: json.dump(report, stream, indent=2))
+        if prometheus_file:
+            content = self.get_prometheus()
+            write_atomically(prometheus_file, lambda stream: stream.write(content))
@@ -0,0 +1,150 @@
+from collections.abc import Mapping
+import sys
+
+# Lists of component templates in a definition, each item becomes one template in NetBox
+COMPONENT_KEYS = ('interfaces', 'power-ports', 'power-port', 'console-ports', 'power-outlets',
+                  'console-server-ports', 'rear-ports', 'front-ports', 'device-bays', 'module-bays')
+# Flags telling that the library has an elevation image of the device type
+IMAGE_KEYS = ('front_image', 'rear_image')
+
+# Every distinct tuple of keys, shared by all Fields with the same keys in the same order
+_key_tuples = {}
+
+
+def freeze(value):
+    '''Return an immutable copy of a parsed YAML value, with its strings interned'''
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return Fields(value)
+    return value
+
+
+def thaw(value):
+    '''Return a frozen value as plain dicts and lists, as pynetbox and json expect'''
+    if isinstance(value, Fields):
+        return value.to_dict()
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class Fields(Mapping):
+    '''Immutable mapping of the fields of a definition or a component template
+
+    The keys live in one tuple that is shared by every instance with the
+    same keys in the same order, e.g. all interfaces with a name and a
+    type, so an instance only holds a tuple of its values. Strings are
+    interned: the same names and types repeat across the whole library.
+    Compares equal to a dict with the same fields.
+    '''
+
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self, mapping):
+        keys = tuple(sys.intern(key) if isinstance(key, str) else key for key in mapping)
+        object.__setattr__(self, '_keys', _key_tuples.setdefault(keys, keys))
+        object.__setattr__(self, '_values', tuple(freeze(value) for value in mapping.values()))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __eq__(self, other):
+        if isinstance(other, Fields) and self._keys is other._keys:
+            return self._values == other._values
+        return super().__eq__(other)
+
+    def __hash__(self):
+        return hash(frozenset(zip(self._keys, self._values)))
+
+    def to_dict(self, **extra):
+        '''Return the fields as a new dict, with extra fields such as the parent of a template'''
+        result = {key: thaw(value) for key, value in zip(self._keys, self._values)}
+        result.update(extra)
+        return result
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+class Definition:
+    '''A parsed device or module type, immutable so every stage and thread can share it
+
+    Reads like the parsed dict: definition['model'] returns a field and
+    definition['interfaces'] the tuple of interface templates. The source
+    file and the image flags are kept apart from the fields sent to NetBox.
+    '''
+
+    __slots__ = ('src', 'fields', 'components', 'images')
+
+    def __init__(self, data):
+        '''
+        Args:
+        data: a definition as parsed by parse_file, with its source file in 'src'
+        '''
+        fields, components, images = {}, {}, []
+        for key, value in data.items():
+            if key == 'src':
+                continue
+            if key in IMAGE_KEYS:
+                if value:
+                    images.append(key)
+            elif key in COMPONENT_KEYS and isinstance(value, list):
+                components[key] = tuple(Fields(component) for component in value)
+            else:
+                fields[key] = value
+        object.__setattr__(self, 'src', data['src'])
+        object.__setattr__(self, 'fields', Fields(fields))
+        object.__setattr__(self, 'components', Fields(components))
+        object.__setattr__(self, 'images', tuple(images))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __getitem__(self, key):
+        if key in self.components:
+            return self.components[key]
+        return self.fields[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.fields or key in self.components
+
+    def to_payload(self):
+        '''Return the fields of the device or module type itself to create it with'''
+        return self.fields.to_dict()
+
+    def to_dict(self):
+        '''Return the definition without its source file and image flags, as plain dicts and lists'''
+        return {**self.fields.to_dict(), **self.components.to_dict()}
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.src!r})'
@@ -1,54 +1,299 @@
 #!/usr/bin/env python3
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlsplit
 import yaml
 import pynetbox
 from glob import glob
 import os
+import sys
 
 import settings
+from daemon import SyncDaemon
 from netbox_api import NetBox
+from repo import FanOut
+from shards import get_result, merge_results, save_result
 
 
-def main():
-    startTime = datetime.now()
+def discover_target(target, files, module_files, full=False):
+    '''Return the device and module type files to import into one NetBox
+
+    Only files that changed since the last successful import into it,
+    that failed then, or whose object was deleted in NetBox since, are
+    imported again.
+    '''
+    dtl_repo, handle = settings.dtl_repo, target['handle']
+    last_commit, retry, module_commit = (None, [], None) if full else dtl_repo.get_last_import(target['url'])
+    changed = dtl_repo.get_changed_files(last_commit)
+    if changed is None:
+        return set(files), set(module_files)
+    changed.update(retry)
+    # The module types were not imported since, e.g. while NetBox had no module support
+    module_changed = changed if module_commit == last_commit else dtl_repo.get_changed_files(module_commit)
+    handle.log(f'{len(changed)} files changed since last import of {last_commit[:12]}')
+    # start_sync() checked the sync manifest against the objects NetBox has
+    dropped = target['netbox'].manifest.dropped
+    deleted = dtl_repo.get_files_of_keys(files, dropped['device-types']) \
+        | dtl_repo.get_files_of_keys(module_files, dropped['module-types'])
+    if deleted:
+        handle.log(f'{len(deleted)} files to import again, their object was deleted in NetBox')
+        changed.update(deleted)
+    if module_changed is None:
+        return set(dtl_repo.filter_changed_files(files, changed)), set(module_files)
+    module_changed.update(changed)
+    return (set(dtl_repo.filter_changed_files(files, changed)),
+            set(dtl_repo.filter_changed_files(module_files, module_changed, images=False)))
+
+
+def connect_target(target):
+    '''Connect to the NetBox of target, kept in the target for later imports'''
+    with target['metrics'].phase('connect'):
+        target['netbox'] = NetBox(settings, target['url'], target['token'], target['handle'], target['metrics'])
+    return target['netbox']
+
+
+def start_target(target, full, resume, manufacturers):
+    '''Connect to the NetBox of target if needed and bring its lookups and sync manifest up to date'''
+    netbox = target.get('netbox') or connect_target(target)
+    with target['metrics'].phase('connect'):
+        netbox.start_sync(full, resume, manufacturers)
+
+
+def run_on_target(target, function, *args):
+    '''Call function, logging its error to the log of target instead of ending the run
+
+    Returns:
+    whether function succeeded, also kept in target['failed']
+    '''
+    target['failed'] = True
+    try:
+        function(*args)
+    except SystemExit:
+        # The error was logged already
+        return False
+    except Exception as error:
+        target['handle'].log(f'Import failed: {error}')
+        return False
+    target['failed'] = False
+    return True
+
+
+def start_targets(targets, full, resume, manufacturers):
+    '''Run start_target for every target, in parallel if there are several
+
+    Runs before discovery, which needs to know the definitions whose
+    object was deleted in NetBox. Only the types of manufacturers, the
+    slugs of the manufacturers of the library files selected, are looked
+    up. A target that fails is marked as failed and left out of the
+    import if there are several.
+    '''
+    if len(targets) == 1:
+        targets[0]['failed'] = True
+        start_target(targets[0], full, resume, manufacturers)
+        targets[0]['failed'] = False
+        return
+
+    with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix='target') as executor:
+        list(executor.map(lambda target: run_on_target(target, start_target, target, full, resume, manufacturers),
+                          targets))
+
+
+def import_target(target, index, vendors, module_vendors, images, device_types, module_types):
+    '''Import the definitions read from the FanOuts device_types and module_types into one NetBox'''
     args = settings.args
+    handle, metrics, netbox = target['handle'], target['metrics'], target['netbox']
+    try:
+        with metrics.phase('manufacturers'):
+            # Every manufacturer is created up front, in one request
+            netbox.create_manufacturers(
+                vendors + [vendor for vendor in module_vendors if vendor not in vendors] if netbox.modules else vendors)
+        with metrics.phase('device-types'):
+            # Existing types are looked up from the index, the definitions are
+            # parsed while earlier ones are written to NetBox
+            netbox.load_types('device_type', *settings.dtl_repo.get_definition_keys(target['files']))
+            count = netbox.create_device_types(device_types.consume(index), images)
+        handle.log(f'{count} Device-Types Found')
+        with metrics.phase('images'):
+            netbox.upload_images()
 
-    netbox = NetBox(settings)
-    files, vendors = settings.dtl_repo.get_devices(
-        f'{settings.dtl_repo.repo_path}/device-types/', args.vendors)
+        if netbox.modules:
+            handle.log("Modules Enabled. Creating Modules...")
+            with metrics.phase('module-types'):
+                netbox.load_types('module_type', *settings.dtl_repo.get_definition_keys(target['module_files']))
+                count = netbox.create_module_types(module_types.consume(index))
+            handle.log(f'{count} Module-Types Found')
+    finally:
+        # The definitions are no longer needed if the import stopped early or has no modules
+        device_types.close(index)
+        module_types.close(index)
 
-    settings.handle.log(f'{len(vendors)} Vendors Found')
-    device_types = settings.dtl_repo.parse_files(files, slugs=args.slugs)
-    settings.handle.log(f'{len(device_types)} Device-Types Found')
-    netbox.create_manufacturers(vendors)
-    netbox.create_device_types(device_types)
-
-    if netbox.modules:
-        settings.handle.log("Modules Enabled. Creating Modules...")
-        files, vendors = settings.dtl_repo.get_devices(
-            f'{settings.dtl_repo.repo_path}/module-types/', args.vendors)
-        settings.handle.log(f'{len(vendors)} Module Vendors Found')
-        module_types = settings.dtl_repo.parse_files(files, slugs=args.slugs)
-        settings.handle.log(f'{len(module_types)} Module-Types Found')
-        netbox.create_manufacturers(vendors)
-        netbox.create_module_types(module_types)
+    # Everything the journal recorded is in NetBox and the manifest now
+    netbox.journal.finish()
 
-    settings.handle.log('---')
-    settings.handle.verbose_log(
-        f'Script took {(datetime.now() - startTime)} to run')
-    settings.handle.log(f'{netbox.counter["added"]} devices created')
-    settings.handle.log(f'{netbox.counter["images"]} images uploaded')
-    settings.handle.log(
+    # A filtered run does not cover the whole library, so it cannot move the mark
+    if not args.vendors and not args.slugs:
+        settings.dtl_repo.save_last_import(target['url'], settings.dtl_repo.get_head_commit(),
+                                           netbox.get_failed_sources(), netbox.modules)
+
+
+def import_targets(targets, *import_args):
+    '''Run import_target for every target start_targets got ready, in parallel if there are several
+
+    Returns:
+    number of targets whose import failed
+    '''
+    if len(targets) == 1:
+        targets[0]['failed'] = True
+        import_target(targets[0], 0, *import_args)
+        targets[0]['failed'] = False
+        return 0
+
+    def run(index):
+        if targets[index]['failed']:
+            return False
+        return run_on_target(targets[index], import_target, targets[index], index, *import_args)
+
+    with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix='target') as executor:
+        return list(executor.map(run, range(len(targets)))).count(False)
+
+
+def log_target_summary(target):
+    handle, netbox = target['handle'], target.get('netbox')
+    if netbox is None:
+        return
+    target['metrics'].log_summary()
+    scheduler = netbox.scheduler.stats
+    if scheduler['throttled'] or scheduler['paused']:
+        handle.log(f"NetBox was overloaded {scheduler['throttled']} times and asked to pause "
+                   + f"{scheduler['paused']} times, requests in flight went down to "
+                   + f"{scheduler['lowest_limit']}")
+    handle.log(f'{netbox.counter["added"]} devices created')
+    handle.log(f'{netbox.counter["images"]} images uploaded')
+    handle.log(
+        f'{netbox.counter["port_added"]} interfaces/ports created')
+    handle.log(
         f'{netbox.counter["updated"]} interfaces/ports updated')
-    settings.handle.log(
+    handle.log(
         f'{netbox.counter["manufacturer"]} manufacturers created')
+    handle.log(
+        f'{netbox.counter["skipped"]} unchanged device/module types skipped')
     if settings.NETBOX_FEATURES['modules']:
-        settings.handle.log(
+        handle.log(
             f'{netbox.counter["module_added"]} modules created')
-        settings.handle.log(
+        handle.log(
             f'{netbox.counter["module_port_added"]} module interface / ports created')
 
 
+def get_targets():
+    '''Return the NetBox instances to import into, each with its log handler and metrics'''
+    metrics = settings.metrics
+    # Several NetBox instances are imported in parallel, each with its own state, log prefix and metrics
+    multiple = len(settings.TARGETS) > 1
+    targets = []
+    for url, token in settings.TARGETS:
+        handle = settings.handle.child(urlsplit(url).netloc or url) if multiple else settings.handle
+        targets.append({'url': url, 'token': token, 'handle': handle,
+                        'metrics': metrics.for_target(url, handle) if multiple else metrics})
+    return targets
+
+
+def run_sync(targets, full=False, resume=False):
+    '''Import the changes of the library into every target and log the summary
+
+    Returns:
+    number of targets whose import failed
+    '''
+    startTime = datetime.now()
+    args = settings.args
+    metrics = settings.metrics
+    dtl_repo = settings.dtl_repo
+
+    with metrics.phase('discovery'):
+        files, vendors = dtl_repo.get_devices(f'{dtl_repo.repo_path}/device-types/', args.vendors, args.slugs,
+                                              args.shard)
+        module_files, module_vendors = dtl_repo.get_devices(
+            f'{dtl_repo.repo_path}/module-types/', args.vendors, args.slugs, args.shard)
+        images = dtl_repo.get_images(args.vendors)
+        manufacturers = dtl_repo.get_definition_keys(files)[0] | dtl_repo.get_definition_keys(module_files)[0] \
+            | {vendor['slug'] for vendor in vendors + module_vendors}
+    start_targets(targets, full, resume, manufacturers)
+    with metrics.phase('discovery'):
+        for target in targets:
+            target['files'], target['module_files'] = (set(), set()) if target['failed'] \
+                else discover_target(target, files, module_files, full)
+
+    if args.shard:
+        settings.handle.log(f'Importing shard {args.shard[0]}/{args.shard[1]}')
+    settings.handle.log(f'{len(vendors)} Vendors Found')
+    settings.handle.log(f'{len(module_vendors)} Module Vendors Found')
+    # Every file is parsed once, for all targets that import it
+    device_types, module_types = [
+        FanOut(metrics.timed('parse', dtl_repo.parse_files(set().union(*(target[key] for target in targets)),
+                                                           slugs=args.slugs)),
+               [lambda data, selected=target[key]: data.src in selected for target in targets],
+               args.workers * 4)
+        for key in ('files', 'module_files')]
+    failed = import_targets(targets, vendors, module_vendors, images, device_types, module_types)
+
+    settings.handle.log('---')
+    settings.handle.verbose_log('Script took %s to run', datetime.now() - startTime)
+    if len(targets) > 1:
+        metrics.log_summary()
+    for target in targets:
+        log_target_summary(target)
+    metrics.save(args.metrics_file, args.prometheus_file)
+    if args.result_file:
+        save_result(args.result_file, get_result(args.shard, dtl_repo.get_head_commit(), vendors + module_vendors,
+                                                 targets, dtl_repo.get_absolute_path()))
+    if failed:
+        settings.handle.log(f'The import into {failed} of {len(targets)} NetBox instances failed')
+    return failed
+
+
+def merge_shards(paths):
+    '''Log the combined results of the shards of an import and write them to --result-file
+
+    Returns:
+    number of problems found, such as missing shards or failed files
+    '''
+    merged, problems = merge_results(paths)
+    settings.handle.log(f"Merged the results of {merged['shards']} shards, {len(merged['vendors'])} vendors")
+    for url, target in merged['targets'].items():
+        counters = target['counters']
+        settings.handle.log(f"{url}: {counters.get('added', 0)} devices, "
+                            + f"{counters.get('module_added', 0)} modules, "
+                            + f"{counters.get('port_added', 0) + counters.get('module_port_added', 0)} "
+                            + f"interfaces/ports, {counters.get('manufacturer', 0)} manufacturers created, "
+                            + f"{counters.get('images', 0)} images uploaded")
+        for path in target['failed_files']:
+            settings.handle.verbose_log('%s: failed %s', url, path)
+    for problem in problems:
+        settings.handle.log(problem)
+    if settings.args.result_file:
+        save_result(settings.args.result_file, merged)
+    return len(problems)
+
+
+def main():
+    args = settings.args
+    if args.merge:
+        if merge_shards(args.merge):
+            sys.exit(1)
+        return
+
+    targets = get_targets()
+
+    if args.daemon:
+        # Connect once, the connections and what they looked up are reused by every sync
+        for target in targets:
+            connect_target(target)
+        return SyncDaemon(run_sync, targets, settings.dtl_repo, settings.handle, settings.metrics, args.interval,
+                          args.listen or None, args.full, args.resume).run()
+
+    if run_sync(targets, args.full, args.resume):
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     main()
@@ -1,37 +1,117 @@
 from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+import threading
 import pynetbox
-import requests
+from pynetbox.core.response import Record
 import os
-import glob
+
+from http_session import MultipartStream, Scheduler, build_session
+from journal import Journal
+from remote_state import RemoteState, chunk_ids
+from sync_manifest import SyncManifest
 # from pynetbox import RequestError as APIRequestError
 
+class LockedCounter(Counter):
+    '''Counter whose update() may be called from several worker threads'''
+
+    def __init__(self, *args, **kwargs):
+        # Counter.update() calls itself for keyword arguments
+        self.lock = threading.RLock()
+        super().__init__(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        with self.lock:
+            super().update(*args, **kwargs)
+
+
 class NetBox:
     def __new__(cls, *args, **kwargs):
         return super().__new__(cls)
 
-    def __init__(self, settings):
-        self.counter = Counter(
+    def __init__(self, settings, url=None, token=None, handle=None, metrics=None):
+        '''Connect to NetBox, by default the one of NETBOX_URL and NETBOX_TOKEN
+
+        Call start_sync() before each import.
+
+        Args:
+        settings: the settings module
+        url, token: NetBox to import into instead, one of several targets
+        handle, metrics: LogHandler and Metrics of that target
+        '''
+        self.settings = settings
+        self.url = url or settings.NETBOX_URL
+        self.metrics = metrics or settings.metrics
+        self.token = token or settings.NETBOX_TOKEN
+        self.handle = handle or settings.handle
+        self.netbox = None
+        self.journal = None
+        self.ignore_ssl = settings.IGNORE_SSL_ERRORS
+        self.modules = False
+        self.workers = settings.args.workers
+        self.http_retries = settings.HTTP_RETRIES
+        # Without a ceiling, as many requests in flight as the pool has connections
+        self.pool_size = max(self.workers, 10, settings.args.max_in_flight)
+        self.scheduler = Scheduler(settings.args.rate_limit, settings.args.max_in_flight or self.pool_size,
+                                   settings.args.max_latency, self.handle)
+        self.connect_api()
+        self.verify_compatibility()
+        # Manufacturers, device and module types as of the last run, brought up to date by start_sync()
+        self.remote_state = RemoteState(RemoteState.get_path(settings.CACHE_PATH, self.url), self.url, self.handle)
+        self.manifest = SyncManifest(os.path.join(settings.CACHE_PATH, 'sync-manifest.json')
+                                     if settings.CACHE_PATH else None, self.url, self.handle)
+
+    def start_sync(self, full=False, resume=False, manufacturer_slugs=None):
+        '''Reset the per-import state and bring the lookups up to date
+
+        The connection, remote state and sync manifest are kept, so a
+        long-running process only pays for the changes since its last import.
+
+        Args:
+        full: check every definition instead of skipping those in the sync manifest
+        resume: skip the types an interrupted import journaled as complete
+        manufacturer_slugs: manufacturers of the definitions about to be imported, None for all
+        '''
+        self.counter = LockedCounter(
             added=0,
             updated=0,
             manufacturer=0,
             module_added=0,
             module_port_added=0,
+            port_added=0,
             images=0,
+            skipped=0,
         )
-        self.url = settings.NETBOX_URL
-        self.token = settings.NETBOX_TOKEN
-        self.handle = settings.handle
-        self.netbox = None
-        self.ignore_ssl = settings.IGNORE_SSL_ERRORS
-        self.modules = False
-        self.connect_api()
-        self.verify_compatibility()
-        self.existing_manufacturers = self.get_manufacturers()
-        self.device_types = DeviceTypes(self.netbox, self.handle, self.counter, self.ignore_ssl)
+        # Definitions that did not import cleanly, by file and by created object
+        self.failed_sources = set()
+        self.sources = {}
+        # Definitions imported in this run, recorded in the manifest once their components exist
+        self.imported = []
+        self.use_manifest = not full
+        # (device type id, {side: path}, {side: image url NetBox reported})
+        self.image_jobs = []
+        self.images = {}
+        self.remote_state.refresh(self.netbox, self.settings.NETBOX_PAGE_SIZE,
+                                  ['manufacturers', 'device_types'] + (['module_types'] if self.modules else []),
+                                  manufacturer_slugs)
+        if self.use_manifest:
+            self.manifest.verify({'device-types': self.remote_state.get_ids('device_types'),
+                                  'module-types': self.remote_state.get_ids('module_types')}, manufacturer_slugs)
+        if self.journal is not None:
+            # Left open by a sync that failed, the new journal continues it with --resume
+            self.journal.close()
+        self.journal = Journal(Journal.get_path(self.settings.CACHE_PATH, self.url), self.url, self.handle, resume)
+        self.existing_manufacturers = self.remote_state.get_manufacturers()
+        self.device_types = DeviceTypes(self.netbox, self.handle, self.counter, self.modules,
+                                        self.settings.NETBOX_PAGE_SIZE, self.settings.args.batch_size,
+                                        self.settings.args.reconcile, self.journal, self.remote_state)
 
     def connect_api(self):
         try:
             self.netbox = pynetbox.api(self.url, token=self.token)
+            # One pooled keep-alive session for every API call and image upload
+            self.netbox.http_session = build_session(pool_size=self.pool_size, retries=self.http_retries,
+                                                     scheduler=self.scheduler)
+            self.metrics.attach(self.netbox.http_session)
             if self.ignore_ssl:
                 self.handle.verbose_log("IGNORE_SSL_ERRORS is True, catching exception and disabling SSL verification.")
                 #requests.packages.urllib3.disable_warnings()
@@ -45,6 +125,65 @@ class NetBox:
     def get_counter(self):
         return self.counter
 
+    def run_concurrently(self, function, items, label=None):
+        '''Call function for every item, on a pool of --workers threads
+
+        Items are taken from the iterable as workers become free, at most
+        two per worker are waiting, so a generator is never read far ahead.
+        Each call's output is buffered and printed as one block so the
+        log lines of concurrently imported types do not interleave.
+        With a label, the number of finished items is shown as progress.
+
+        Returns:
+        number of items processed
+        '''
+        done = 0
+
+        def finished(future=None):
+            nonlocal done
+            if future is not None:
+                future.result()
+            done += 1
+            if label:
+                self.handle.progress(label, done)
+
+        def run(item):
+            with self.handle.buffered():
+                function(item)
+
+        if self.workers <= 1:
+            for item in items:
+                function(item)
+                finished()
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = set()
+                for item in items:
+                    if len(pending) >= self.workers * 2:
+                        completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in completed:
+                            finished(future)
+                    pending.add(executor.submit(run, item))
+                for future in as_completed(pending):
+                    finished(future)
+        if label:
+            self.handle.progress(None)
+        return done
+
+    def record_imported(self):
+        '''Add the definitions of this run that imported cleanly to the manifest'''
+        failed_sources = self.get_failed_sources()
+        for kind, key, digest, object_id, src_file in self.imported:
+            if src_file not in failed_sources:
+                self.manifest.record(kind, key, digest, object_id)
+        self.imported = []
+        self.manifest.save()
+
+    def get_failed_sources(self):
+        '''Return the files whose definition, components or images failed to import'''
+        return self.failed_sources | {self.sources[parent] for parent in self.device_types.failed_parents
+                                      if parent in self.sources}
+
     def verify_compatibility(self):
         # nb.version should be the version in the form '3.2'
         version_split = [int(x) for x in self.netbox.version.split('.')]
@@ -54,414 +193,786 @@ class NetBox:
         if version_split[0] > 3 or (version_split[0] == 3 and version_split[1] >= 2):
             self.modules = True
 
-    def get_manufacturers(self):
-        return {str(item): item for item in self.netbox.dcim.manufacturers.all()}
-
     def create_manufacturers(self, vendors):
         to_create = []
-        self.existing_manufacturers = self.get_manufacturers()
         for vendor in vendors:
             try:
                 manGet = self.existing_manufacturers[vendor["name"]]
-                self.handle.verbose_log(f'Manufacturer Exists: {manGet.name} - {manGet.id}')
+                self.handle.verbose_log('Manufacturer Exists: %s - %s', manGet["name"], manGet["id"])
             except KeyError:
                 to_create.append(vendor)
-                self.handle.verbose_log(f"Manufacturer queued for addition: {vendor['name']}")
+                self.handle.verbose_log("Manufacturer queued for addition: %s", vendor['name'])
 
         if to_create:
             try:
                 created_manufacturers = self.netbox.dcim.manufacturers.create(to_create)
                 for manufacturer in created_manufacturers:
-                    self.handle.verbose_log(f'Manufacturer Created: {manufacturer.name} - '
-                        + f'{manufacturer.id}')
+                    self.handle.verbose_log('Manufacturer Created: %s - %s', manufacturer.name, manufacturer.id)
                     self.counter.update({'manufacturer': 1})
+                    self.remote_state.add('manufacturers', dict(manufacturer))
+                self.existing_manufacturers = self.remote_state.get_manufacturers()
             except pynetbox.RequestError as request_error:
                 self.handle.log("Error creating manufacturers")
-                self.handle.verbose_log(f"Error during manufacturer creation. - {request_error.error}")
-
-    def create_device_types(self, device_types_to_add):
-        for device_type in device_types_to_add:
-
-            # Remove file base path
-            src_file = device_type["src"]
-            del device_type["src"]
-
-            # Pre-process front/rear_image flag, remove it if present
-            saved_images = {}
-            image_base = os.path.dirname(src_file).replace("device-types","elevation-images")
-            for i in ["front_image","rear_image"]:
-                if i in device_type:
-                    if device_type[i]:
-                        image_glob = f"{image_base}/{device_type['slug']}.{i.split('_')[0]}.*"
-                        images = glob.glob(image_glob, recursive=False)
-                        if images:
-                          saved_images[i] = images[0]
-                        else:
-                          self.handle.log(f"Error locating image file using '{image_glob}'")
-                    del device_type[i]
+                self.handle.verbose_log("Error during manufacturer creation. - %s", request_error.error)
 
-            try:
-                dt = self.device_types.existing_device_types[device_type["model"]]
-                self.handle.verbose_log(f'Device Type Exists: {dt.manufacturer.name} - '
-                    + f'{dt.model} - {dt.id}')
-            except KeyError:
-                try:
-                    dt = self.netbox.dcim.device_types.create(device_type)
-                    self.counter.update({'added': 1})
-                    self.handle.verbose_log(f'Device Type Created: {dt.manufacturer.name} - '
-                        + f'{dt.model} - {dt.id}')
-                except pynetbox.RequestError as e:
-                    self.handle.log(f'Error {e.error} creating device type:'
-                                    f' {device_type["manufacturer"]["name"]} {device_type["model"]}')
-                    continue
+    def get_manufacturer_ids(self, slugs):
+        '''Return the ids of the existing manufacturers with one of the slugs'''
+        return {manufacturer['id'] for manufacturer in self.existing_manufacturers.values()
+                if manufacturer['slug'] in slugs}
 
-            if "interfaces" in device_type:
-                self.device_types.create_interfaces(device_type["interfaces"], dt.id)
-            if "power-ports" in device_type:
-                self.device_types.create_power_ports(device_type["power-ports"], dt.id)
-            if "power-port" in device_type:
-                self.device_types.create_power_ports(device_type["power-port"], dt.id)
-            if "console-ports" in device_type:
-                self.device_types.create_console_ports(device_type["console-ports"], dt.id)
-            if "power-outlets" in device_type:
-                self.device_types.create_power_outlets(device_type["power-outlets"], dt.id)
-            if "console-server-ports" in device_type:
-                self.device_types.create_console_server_ports(device_type["console-server-ports"], dt.id)
-            if "rear-ports" in device_type:
-                self.device_types.create_rear_ports(device_type["rear-ports"], dt.id)
-            if "front-ports" in device_type:
-                self.device_types.create_front_ports(device_type["front-ports"], dt.id)
-            if "device-bays" in device_type:
-                self.device_types.create_device_bays(device_type["device-bays"], dt.id)
-            if self.modules and 'module-bays' in device_type:
-                self.device_types.create_module_bays(device_type['module-bays'], dt.id)
-
-            # Finally, update images if any
-            if saved_images:
-                self.device_types.upload_images(self.url, self.token, saved_images, dt.id)
+    def load_types(self, parent_type, manufacturer_slugs, keys):
+        '''Look up the existing types of the definitions about to be imported
 
-    def create_module_types(self, module_types):
-        all_module_types = {}
-        for curr_nb_mt in self.netbox.dcim.module_types.all():
-            if curr_nb_mt.manufacturer.slug not in all_module_types:
-                all_module_types[curr_nb_mt.manufacturer.slug] = {}
+        Called before the definitions are parsed, with what the repository
+        index knows about them. Definitions it missed are looked up on demand.
+        '''
+        self.device_types.load_types(parent_type, self.get_manufacturer_ids(manufacturer_slugs), keys)
+        # Types a resumed run created before it died
+        kind = 'device-types' if parent_type == 'device_type' else 'module-types'
+        self.device_types.seed_types(parent_type, {tuple(key.split('/', 1)): object_id for key, object_id
+                                                   in self.journal.get_ids(kind).items()})
 
-            all_module_types[curr_nb_mt.manufacturer.slug][curr_nb_mt.model] = curr_nb_mt
+    def create_device_types(self, device_types_to_add, images: dict = None):
+        '''Import device types as they are read from device_types_to_add
 
+        Returns:
+        number of device types processed
+        '''
+        self.images = images or {}
+        count = self.run_concurrently(self.create_device_type, device_types_to_add, 'Device-Types')
+        self.device_types.flush_components()
+        self.record_imported()
+        return count
+
+    def upload_images(self):
+        '''Upload the queued elevation images NetBox is missing or that changed locally'''
+        jobs, self.image_jobs = self.image_jobs, []
+
+        def recorded(device_type, side):
+            # A --full run checks the images NetBox has instead of the manifest
+            return self.use_manifest and self.manifest.has_image(device_type, side)
+
+        # Existing types were looked up in brief form, their images are only
+        # asked for where the manifest has no upload recorded
+        unknown = {device_type for device_type, images, reported in jobs
+                   if any(side not in reported and not recorded(device_type, side) for side in images)}
+        reported_images = self.get_reported_images(unknown)
+        uploads = []
+        for device_type, images, reported in jobs:
+            reported = {**reported_images.get(device_type, {}), **reported}
+            changed = {}
+            for side, path in images.items():
+                if side in reported and not reported[side]:
+                    changed[side] = path
+                    continue
+                reported_size = None
+                if reported.get(side) and not recorded(device_type, side):
+                    reported_size = self.get_remote_size(reported[side])
+                if not self.manifest.image_changed(device_type, side, path, reported_size, self.use_manifest):
+                    self.handle.verbose_log('Image Unchanged: %s - %s', path, device_type)
+                else:
+                    changed[side] = path
+            if changed:
+                uploads.append((device_type, changed))
+
+        self.run_concurrently(self.upload_device_type_images, uploads, 'Images')
+        self.manifest.save()
+
+    def upload_device_type_images(self, job):
+        device_type, images = job
+        if self.device_types.upload_images(self.url, self.token, images, device_type):
+            for side, path in images.items():
+                self.manifest.record_image(device_type, side, path)
+        else:
+            for side in images:
+                self.manifest.forget_image(device_type, side)
+
+    def get_reported_images(self, device_type_ids):
+        '''Return {device type id: {side: image url or None}} of some device types as NetBox reports them'''
+        reported = {}
+        try:
+            for chunk in chunk_ids('id', device_type_ids):
+                for item in self.netbox.dcim.device_types.filter(id=chunk, fields='id,front_image,rear_image',
+                                                                 limit=self.settings.NETBOX_PAGE_SIZE):
+                    record = vars(item)
+                    reported[item.id] = {side: record.get(side) for side in ('front_image', 'rear_image')}
+        except pynetbox.RequestError as request_error:
+            self.handle.verbose_log('Could not look up the images of existing device types: %s', request_error.error)
+        return reported
+
+    def get_remote_size(self, url):
+        '''Return the size NetBox serves an image with, or None if unknown'''
+        try:
+            response = self.netbox.http_session.head(url, headers={"Authorization": f"Token {self.token}"})
+        except Exception as head_error:
+            self.handle.verbose_log('Could not check image %s: %s', url, head_error)
+            return None
+        if not response.ok or 'Content-Length' not in response.headers:
+            return None
+        return int(response.headers['Content-Length'])
+
+    def create_device_type(self, device_type):
+        src_file = device_type.src
+
+        # Look up the files of the images the definition has
+        saved_images = {}
+        vendor = os.path.basename(os.path.dirname(src_file))
+        for i in device_type.images:
+            image = self.images.get((vendor, device_type['slug']), {}).get(i)
+            if image:
+                saved_images[i] = image
+            else:
+                self.handle.log(f"Error locating image file for '{vendor}/{device_type['slug']}.{i.split('_')[0]}.*'")
+
+        key = self.manifest.get_key(device_type)
+        digest = self.manifest.hash_definition(device_type)
+        if self.use_manifest and self.manifest.is_current('device-types', key, digest):
+            self.counter.update({'skipped': 1})
+            self.handle.verbose_log('Device Type Unchanged: %s', key)
+            if saved_images:
+                self.image_jobs.append((self.manifest.get_id('device-types', key), saved_images, {}))
+            return
+        if self.journal.is_complete('device-types', key, digest):
+            dt_id = self.journal.get_id('device-types', key)
+            self.counter.update({'skipped': 1})
+            self.handle.verbose_log('Device Type Imported Before Resume: %s', key)
+            self.imported.append(('device-types', key, digest, dt_id, src_file))
+            if saved_images:
+                self.image_jobs.append((dt_id, saved_images, {}))
+            return
+
+        type_key = (device_type['manufacturer']['slug'], device_type['model'])
+        dt_id = self.device_types.get_type_id('device_type', type_key, self.get_manufacturer_ids([type_key[0]]))
+        reported = {}
+        if dt_id:
+            self.handle.verbose_log('Device Type Exists: %s - %s - %s', device_type['manufacturer']['name'],
+                                    device_type['model'], dt_id)
+        else:
+            try:
+                dt = self.netbox.dcim.device_types.create(device_type.to_payload())
+                dt_id = dt.id
+                self.device_types.add_type('device_type', type_key, dt_id)
+                reported = {side: vars(dt).get(side) for side in saved_images}
+                self.counter.update({'added': 1})
+                self.handle.verbose_log('Device Type Created: %s - %s - %s', device_type['manufacturer']['name'],
+                                        device_type['model'], dt_id)
+            except pynetbox.RequestError as e:
+                self.handle.log(f'Error {e.error} creating device type:'
+                                f' {device_type["manufacturer"]["name"]} {device_type["model"]}')
+                self.failed_sources.add(src_file)
+                return
+
+        self.sources[('device_type', dt_id)] = src_file
+        self.imported.append(('device-types', key, digest, dt_id, src_file))
+        self.journal.record_type('device-types', key, digest, dt_id)
+
+        if "interfaces" in device_type:
+            self.device_types.create_interfaces(device_type["interfaces"], dt_id)
+        if "power-ports" in device_type:
+            self.device_types.create_power_ports(device_type["power-ports"], dt_id)
+        if "power-port" in device_type:
+            self.device_types.create_power_ports(device_type["power-port"], dt_id)
+        if "console-ports" in device_type:
+            self.device_types.create_console_ports(device_type["console-ports"], dt_id)
+        if "power-outlets" in device_type:
+            self.device_types.create_power_outlets(device_type["power-outlets"], dt_id)
+        if "console-server-ports" in device_type:
+            self.device_types.create_console_server_ports(device_type["console-server-ports"], dt_id)
+        if "rear-ports" in device_type:
+            self.device_types.create_rear_ports(device_type["rear-ports"], dt_id)
+        if "front-ports" in device_type:
+            self.device_types.create_front_ports(device_type["front-ports"], dt_id)
+        if "device-bays" in device_type:
+            self.device_types.create_device_bays(device_type["device-bays"], dt_id)
+        if self.modules and 'module-bays' in device_type:
+            self.device_types.create_module_bays(device_type['module-bays'], dt_id)
+        self.device_types.seal('device_type', dt_id, ('device-types', key, digest, dt_id))
+
+        # Finally, queue images if any for the image stage
+        # Of existing types, upload_images() only asks NetBox for images the manifest has no upload of
+        if saved_images:
+            self.image_jobs.append((dt_id, saved_images, reported))
 
-        for curr_mt in module_types:
+    def create_module_types(self, module_types):
+        '''Import module types as they are read from module_types
+
+        Returns:
+        number of module types processed
+        '''
+        count = self.run_concurrently(self.create_module_type, module_types, 'Module-Types')
+        self.device_types.flush_components()
+        self.record_imported()
+        return count
+
+    def create_module_type(self, curr_mt):
+        key = self.manifest.get_key(curr_mt)
+        digest = self.manifest.hash_definition(curr_mt)
+        if self.use_manifest and self.manifest.is_current('module-types', key, digest):
+            self.counter.update({'skipped': 1})
+            self.handle.verbose_log('Module Type Unchanged: %s', key)
+            return
+        if self.journal.is_complete('module-types', key, digest):
+            self.counter.update({'skipped': 1})
+            self.handle.verbose_log('Module Type Imported Before Resume: %s', key)
+            self.imported.append(('module-types', key, digest, self.journal.get_id('module-types', key),
+                                  curr_mt.src))
+            return
+
+        type_key = (curr_mt['manufacturer']['slug'], curr_mt['model'])
+        module_type_id = self.device_types.get_type_id('module_type', type_key,
+                                                       self.get_manufacturer_ids([type_key[0]]))
+        if module_type_id:
+            self.handle.verbose_log('Module Type Exists: %s - %s - %s', curr_mt['manufacturer']['name'],
+                                    curr_mt['model'], module_type_id)
+        else:
             try:
-                module_type_res = all_module_types[curr_mt['manufacturer']['slug']][curr_mt["model"]]
-                self.handle.verbose_log(f'Module Type Exists: {module_type_res.manufacturer.name} - '
-                    + f'{module_type_res.model} - {module_type_res.id}')
-            except KeyError:
-                try:
-                    module_type_res = self.netbox.dcim.module_types.create(curr_mt)
-                    self.counter.update({'module_added': 1})
-                    self.handle.verbose_log(f'Module Type Created: {module_type_res.manufacturer.name} - '
-                        + f'{module_type_res.model} - {module_type_res.id}')
-                except pynetbox.RequestError as exce:
-                    self.handle.log(f"Error '{exce.error}' creating module type: " +
-                        f"{curr_mt}")
-
-            if "interfaces" in curr_mt:
-                self.device_types.create_module_interfaces(curr_mt["interfaces"], module_type_res.id)
-            if "power-ports" in curr_mt:
-                self.device_types.create_module_power_ports(curr_mt["power-ports"], module_type_res.id)
-            if "console-ports" in curr_mt:
-                self.device_types.create_module_console_ports(curr_mt["console-ports"], module_type_res.id)
-            if "power-outlets" in curr_mt:
-                self.device_types.create_module_power_outlets(curr_mt["power-outlets"], module_type_res.id)
-            if "console-server-ports" in curr_mt:
-                self.device_types.create_module_console_server_ports(curr_mt["console-server-ports"], module_type_res.id)
-            if "rear-ports" in curr_mt:
-                self.device_types.create_module_rear_ports(curr_mt["rear-ports"], module_type_res.id)
-            if "front-ports" in curr_mt:
-                self.device_types.create_module_front_ports(curr_mt["front-ports"], module_type_res.id)
+                module_type_res = self.netbox.dcim.module_types.create(curr_mt.to_payload())
+                module_type_id = module_type_res.id
+                self.device_types.add_type('module_type', type_key, module_type_id)
+                self.counter.update({'module_added': 1})
+                self.handle.verbose_log('Module Type Created: %s - %s - %s', curr_mt['manufacturer']['name'],
+                                        curr_mt['model'], module_type_id)
+            except pynetbox.RequestError as exce:
+                self.handle.log(f"Error '{exce.error}' creating module type: " +
+                    f"{curr_mt['manufacturer']['name']} {curr_mt['model']}")
+                self.failed_sources.add(curr_mt.src)
+                return
+
+        self.sources[('module_type', module_type_id)] = curr_mt.src
+        self.imported.append(('module-types', key, digest, module_type_id, curr_mt.src))
+        self.journal.record_type('module-types', key, digest, module_type_id)
+
+        if "interfaces" in curr_mt:
+            self.device_types.create_module_interfaces(curr_mt["interfaces"], module_type_id)
+        if "power-ports" in curr_mt:
+            self.device_types.create_module_power_ports(curr_mt["power-ports"], module_type_id)
+        if "console-ports" in curr_mt:
+            self.device_types.create_module_console_ports(curr_mt["console-ports"], module_type_id)
+        if "power-outlets" in curr_mt:
+            self.device_types.create_module_power_outlets(curr_mt["power-outlets"], module_type_id)
+        if "console-server-ports" in curr_mt:
+            self.device_types.create_module_console_server_ports(curr_mt["console-server-ports"], module_type_id)
+        if "rear-ports" in curr_mt:
+            self.device_types.create_module_rear_ports(curr_mt["rear-ports"], module_type_id)
+        if "front-ports" in curr_mt:
+            self.device_types.create_module_front_ports(curr_mt["front-ports"], module_type_id)
+        self.device_types.seal('module_type', module_type_id, ('module-types', key, digest, module_type_id))
 
 class DeviceTypes:
     def __new__(cls, *args, **kwargs):
         return super().__new__(cls)
 
-    def __init__(self, netbox, handle, counter, ignore_ssl):
+    def __init__(self, netbox, handle, counter, modules=False, page_size=1000, batch_size=500,
+                 reconcile=False, journal=None, remote_state=None):
         self.netbox = netbox
+        self.remote_state = remote_state
         self.handle = handle
         self.counter = counter
-        self.existing_device_types = self.get_device_types()
-        self.ignore_ssl = ignore_ssl
+        self.modules = modules
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.pending_components = {}
+        self.pending_updates = {}
+        self.reconcile = reconcile
+        self.pending_lock = threading.Lock()
+        self.failed_parents = set()
+        self.journal = journal
+        # Queued templates per (parent_type, id), and the journal entries of parents waiting for theirs
+        self.outstanding = Counter()
+        self.sealed = {}
+        # {parent_type: {(manufacturer slug, model): id}} of the manufacturers being imported
+        self.existing_types = {'device_type': {}, 'module_type': {}}
+        # Manufacturers whose existing types were looked up
+        self.loaded_manufacturers = {'device_type': set(), 'module_type': set()}
+        # Existing types whose component templates are prefetched on first use
+        self.parent_ids = {'device_type': set(), 'module_type': set()}
+        self.component_endpoints = [
+            'interface_templates',
+            'power_port_templates',
+            'console_port_templates',
+            'power_outlet_templates',
+            'console_server_port_templates',
+            'rear_port_templates',
+            'front_port_templates',
+            'device_bay_templates',
+        ]
+        if self.modules:
+            self.component_endpoints.append('module_bay_templates')
+        # Dependencies between templates: fields that name another template of
+        # the same parent. They are queued by name and resolved to the id the
+        # referenced template got once it was created, right before sending.
+        # Every template depends on its device or module type, which exists
+        # before any of its templates is queued.
+        self.component_references = {
+            'power_outlet_templates': {'power_port': 'power_port_templates'},
+            'front_port_templates': {'rear_port': 'rear_port_templates'},
+        }
+        # Held while an endpoint's queue is being sent, so a flush returns only
+        # once every previously queued row of that endpoint has been created.
+        self.endpoint_locks = {endpoint: threading.Lock() for endpoint in self.component_endpoints}
+        # Fetched on first use, a run that skips every type never needs them
+        self.cached_components = {endpoint: {} for endpoint in self.component_endpoints}
+        # (parent_type, id) whose templates are cached, or that were created in this run
+        self.known_parents = set()
+        self.cache_lock = threading.Lock()
+        self.types_lock = threading.Lock()
+
+    def get_type_ids(self, endpoint, manufacturer_ids):
+        '''Return the device or module types of some manufacturers, from the refreshed remote state
+
+        The types of manufacturers the remote state was not refreshed for are
+        listed first, e.g. of a definition the repository index missed.
+
+        Returns:
+        {(manufacturer slug, model): id}
+        '''
+        self.remote_state.load_manufacturers(self.netbox, endpoint, manufacturer_ids, self.page_size)
+        return self.remote_state.get_types(endpoint, set(manufacturer_ids))
+
+    def load_types(self, parent_type, manufacturer_ids, keys):
+        '''Look up the existing types of the definitions about to be imported
+
+        Args:
+        parent_type: device_type or module_type
+        manufacturer_ids: ids of the manufacturers of the definitions
+        keys: (manufacturer slug, model) of the definitions
+        '''
+        endpoint = 'device_types' if parent_type == 'device_type' else 'module_types'
+        existing = self.get_type_ids(endpoint, manufacturer_ids)
+        with self.types_lock:
+            self.existing_types[parent_type] = existing
+            self.loaded_manufacturers[parent_type] = set(manufacturer_ids)
+        with self.cache_lock:
+            self.parent_ids[parent_type] = {existing[key] for key in keys if key in existing}
+        self.handle.verbose_log('Found %s existing %s, %s of them in this import', len(existing), endpoint,
+                                len(self.parent_ids[parent_type]))
+
+    def get_type_id(self, parent_type, key, manufacturer_ids):
+        '''Return the id of an existing type, or None
+
+        Types of manufacturers load_types was not told about are looked up here.
+        '''
+        with self.types_lock:
+            type_id = self.existing_types[parent_type].get(key)
+            missing = set(manufacturer_ids) - self.loaded_manufacturers[parent_type]
+            if type_id is None and missing:
+                endpoint = 'device_types' if parent_type == 'device_type' else 'module_types'
+                self.existing_types[parent_type].update(self.get_type_ids(endpoint, missing))
+                self.loaded_manufacturers[parent_type].update(missing)
+                type_id = self.existing_types[parent_type].get(key)
+        return type_id
+
+    def add_type(self, parent_type, key, type_id):
+        '''Remember a type created in this run, it has no templates to fetch'''
+        with self.types_lock:
+            self.existing_types[parent_type][key] = type_id
+        with self.cache_lock:
+            self.known_parents.add((parent_type, type_id))
+
+    def seed_types(self, parent_type, types):
+        '''Add {(manufacturer slug, model): id} of types known to exist, e.g. from the journal'''
+        with self.types_lock:
+            for key, type_id in types.items():
+                self.existing_types[parent_type].setdefault(key, type_id)
+
+    def get_components(self, parent_type, parent_ids):
+        '''Fetch the component templates of some device or module types
+
+        Returns:
+        {endpoint: {(parent_type, parent_id): {name: template}}}
+        '''
+        cached_components = {}
+        id_filter = 'devicetype_id' if parent_type == 'device_type' else 'moduletype_id'
+        chunks = list(chunk_ids(id_filter, parent_ids))
+        for endpoint in self.component_endpoints:
+            cache = cached_components[endpoint] = {}
+            # Bays only exist on device types
+            if parent_type == 'module_type' and endpoint in ('device_bay_templates', 'module_bay_templates'):
+                continue
+            for chunk in chunks:
+                for item in getattr(self.netbox.dcim, endpoint).filter(**{id_filter: chunk}, limit=self.page_size):
+                    # Read the raw attributes, a missing attribute would make pynetbox fetch the full record
+                    parent = vars(item).get(parent_type)
+                    if parent:
+                        cache.setdefault((parent_type, parent.id), {})[str(item)] = item
+            self.handle.verbose_log('Cached %s %s parents from %s', len(cache), parent_type, endpoint)
+        return cached_components
+
+    def get_existing_components(self, endpoint, parent_type, parent_id):
+        '''Return {name: template} of one parent, fetching templates on first use
+
+        The first lookup fetches the templates of every type load_types
+        found, later lookups of types it missed fetch just that type.
+        '''
+        if (parent_type, parent_id) not in self.known_parents:
+            with self.cache_lock:
+                if (parent_type, parent_id) not in self.known_parents:
+                    parent_ids = self.parent_ids[parent_type] | {parent_id}
+                    self.parent_ids[parent_type] = set()
+                    for cached_endpoint, cache in self.get_components(parent_type, parent_ids).items():
+                        self.cached_components[cached_endpoint].update(cache)
+                    self.known_parents.update((parent_type, known_id) for known_id in parent_ids)
+        return self.cached_components[endpoint].setdefault((parent_type, parent_id), {})
+
+    def queue_components(self, endpoint, to_create, port_type):
+        '''Queue templates for bulk creation, flushing the endpoint once a batch is full'''
+        with self.pending_lock:
+            pending = self.pending_components.setdefault(endpoint, [])
+            pending.extend((port_type, port) for port in to_create)
+            self.outstanding.update(self.get_parent(port) for port in to_create)
+            full = len(pending) >= self.batch_size
+        if full:
+            self.flush_components(endpoint)
+
+    def queue_updates(self, endpoint, ports, existing_ports, port_type):
+        '''Queue changes for existing templates whose fields drifted from the definition'''
+        if not self.reconcile:
+            return
+        to_update = []
+        for port in ports:
+            existing = existing_ports.get(port['name'])
+            if existing is None:
+                continue
+            changes = self.get_changed_fields(endpoint, port, existing)
+            if changes:
+                # name and parent are unchanged, they identify the row in logs and the cache
+                parent_type = 'module_type' if vars(existing).get('module_type') else 'device_type'
+                changes.update(id=existing.id, name=port['name'])
+                changes[parent_type] = vars(existing)[parent_type].id
+                to_update.append(changes)
+
+        if to_update:
+            with self.pending_lock:
+                pending = self.pending_updates.setdefault(endpoint, [])
+                pending.extend((port_type, row) for row in to_update)
+                self.outstanding.update(self.get_parent(row) for row in to_update)
+                full = len(pending) >= self.batch_size
+            if full:
+                self.flush_components(endpoint)
+
+    def get_changed_fields(self, endpoint, port, existing):
+        '''Return {field: desired value} for the fields of existing that differ from port'''
+        record = vars(existing)
+        parent_type = 'module_type' if record.get('module_type') else 'device_type'
+        changes = {}
+        for field, desired in port.items():
+            if field in ('name', 'device_type', 'module_type') or field not in record:
+                continue
+            if field in self.component_references.get(endpoint, {}):
+                # References are given by name, compare the id they resolve to
+                referenced = self.get_existing_components(self.component_references[endpoint][field],
+                                                          parent_type, record[parent_type].id).get(desired)
+                if referenced is None:
+                    continue
+                desired = referenced.id
+            current = record[field]
+            if isinstance(current, Record):
+                current = vars(current).get('value', vars(current).get('id'))
+            if isinstance(current, (list, dict)):
+                continue
+            if current != desired:
+                changes[field] = desired
+        return changes
+
+    def flush_components(self, endpoint=None):
+        '''Send all queued creates and updates of one endpoint, or of every endpoint'''
+        for endpoint in [endpoint] if endpoint else self.component_endpoints:
+            with self.endpoint_locks[endpoint]:
+                with self.pending_lock:
+                    pending = self.pending_components.pop(endpoint, [])
+                    pending_updates = self.pending_updates.pop(endpoint, [])
+                if pending and endpoint in self.component_references:
+                    self.resolve_references(endpoint, pending)
+                for start in range(0, len(pending), self.batch_size):
+                    self.write_components(endpoint, pending[start:start + self.batch_size])
+                    self.written(pending[start:start + self.batch_size])
+                for start in range(0, len(pending_updates), self.batch_size):
+                    self.write_components(endpoint, pending_updates[start:start + self.batch_size], update=True)
+                    self.written(pending_updates[start:start + self.batch_size])
+
+    def resolve_references(self, endpoint, pending):
+        '''Replace the template names in the reference fields of pending rows with ids
+
+        The referenced templates are flushed first. Their ids come from the
+        responses of their bulk creates, or from the prefetched templates.
+        '''
+        references = self.component_references[endpoint]
+        for referenced_endpoint in set(references.values()):
+            self.flush_components(referenced_endpoint)
+        for port_type, port in pending:
+            parent_type, parent_id = self.get_parent(port)
+            for field, referenced_endpoint in references.items():
+                name = port.get(field)
+                if not isinstance(name, str):
+                    continue
+                referenced = self.get_existing_components(referenced_endpoint, parent_type, parent_id).get(name)
+                if referenced is None:
+                    self.handle.log(f'Could not find {field.replace("_", " ").title()} {name} for {port_type}: '
+                                    + f'{port["name"]} - {port.get("type")} - {parent_id}')
+                    continue
+                port[field] = referenced.id
 
-    def get_device_types(self):
-        return {str(item): item for item in self.netbox.dcim.device_types.all()}
+    @staticmethod
+    def get_parent(port):
+        parent_type = 'module_type' if 'module_type' in port else 'device_type'
+        return parent_type, port[parent_type]
+
+    def seal(self, parent_type, parent_id, entry):
+        '''Journal entry as complete once every queued template of the parent was written
+
+        Called after all templates of a parent were queued. Parents with
+        templates that failed are not journaled as complete.
+        '''
+        parent = (parent_type, parent_id)
+        with self.pending_lock:
+            if self.outstanding[parent] > 0:
+                self.sealed[parent] = entry
+                return
+        self.complete(parent, entry)
+
+    def written(self, batch):
+        '''Count a sent batch against its parents and journal the parents it completed'''
+        completed = []
+        with self.pending_lock:
+            for _, port in batch:
+                parent = self.get_parent(port)
+                self.outstanding[parent] -= 1
+                if self.outstanding[parent] <= 0:
+                    del self.outstanding[parent]
+                    if parent in self.sealed:
+                        completed.append((parent, self.sealed.pop(parent)))
+        for parent, entry in completed:
+            self.complete(parent, entry)
+
+    def complete(self, parent, entry):
+        if self.journal is not None and parent not in self.failed_parents:
+            self.journal.record_type(*entry, complete=True)
+
+    def write_components(self, endpoint, batch, update=False):
+        '''Bulk create, or with update=True bulk PATCH, one batch of (port_type, port) entries
+
+        NetBox rejects the whole batch when a single row is invalid. Rows it
+        reports errors for are logged against their parent and dropped, the
+        remaining rows are sent again. If the error cannot be attributed to
+        rows, the batch is split in halves until the offending row is found.
+        Only a 400 is split or sent again: any other error, such as 403 or
+        a 5xx NetBox may have applied already, is logged once for the whole
+        batch, which is dropped and its parents are not journaled as complete.
+        '''
+        api = getattr(self.netbox.dcim, endpoint)
+        try:
+            rows = [port for _, port in batch]
+            written = api.update(rows) if update else api.create(rows)
+        except pynetbox.RequestError as excep:
+            if excep.req.status_code != 400:
+                self.failed_parents.update(self.get_parent(port) for _, port in batch)
+                self.handle.log(f"Error '{excep.error}' {'updating' if update else 'creating'} "
+                                + f"{len(batch)} {endpoint} in one batch")
+                return
+            row_errors = self.get_row_errors(excep, len(batch))
+            if row_errors is None:
+                if len(batch) == 1:
+                    self.log_component_error(excep.error, *batch[0], update=update)
+                    return
+                middle = len(batch) // 2
+                self.write_components(endpoint, batch[:middle], update)
+                self.write_components(endpoint, batch[middle:], update)
+                return
+
+            retry = []
+            for entry, row_error in zip(batch, row_errors):
+                if row_error:
+                    self.log_component_error(row_error, *entry, update=update)
+                else:
+                    retry.append(entry)
+            if retry:
+                self.write_components(endpoint, retry, update)
+            return
+
+        written_by_type = {}
+        journaled = []
+        for (port_type, port), item in zip(batch, written):
+            parent_type = 'module_type' if 'module_type' in port else 'device_type'
+            self.get_existing_components(endpoint, parent_type, port[parent_type])[str(item)] = item
+            written_by_type.setdefault((parent_type, port_type), []).append(item)
+            journaled.append([parent_type, port[parent_type], port['name'], item.id])
+        if self.journal is not None:
+            self.journal.record_batch(endpoint, journaled)
+
+        action = "Updated" if update else "Created"
+        for (parent_type, port_type), items in written_by_type.items():
+            if parent_type == 'module_type':
+                count = self.handle.log_module_ports_created(items, port_type, action)
+            else:
+                count = self.handle.log_device_ports_created(items, port_type, action)
+            if update:
+                self.counter.update({'updated': count})
+            else:
+                self.counter.update({'module_port_added' if parent_type == 'module_type' else 'port_added': count})
+
+    def get_row_errors(self, excep, rows):
+        '''Return NetBox's per-row errors for a failed bulk request, or None'''
+        try:
+            row_errors = excep.req.json()
+        except ValueError:
+            return None
+        if not isinstance(row_errors, list) or len(row_errors) != rows or not any(row_errors):
+            return None
+        return row_errors
+
+    def log_component_error(self, error, port_type, port, update=False):
+        parent_type = 'module_type' if 'module_type' in port else 'device_type'
+        self.failed_parents.add((parent_type, port[parent_type]))
+        self.handle.log(f"Error '{error}' {'updating' if update else 'creating'} {port_type}: {port['name']} - "
+                        + f"{parent_type} {port[parent_type]}")
 
     def get_power_ports(self, device_type):
-        return {str(item): item for item in self.netbox.dcim.power_port_templates.filter(devicetype_id=device_type)}
+        return self.get_existing_components('power_port_templates', 'device_type', device_type)
 
     def get_rear_ports(self, device_type):
-        return {str(item): item for item in self.netbox.dcim.rear_port_templates.filter(devicetype_id=device_type)}
+        return self.get_existing_components('rear_port_templates', 'device_type', device_type)
 
     def get_module_power_ports(self, module_type):
-        return {str(item): item for item in self.netbox.dcim.power_port_templates.filter(moduletype_id=module_type)}
+        return self.get_existing_components('power_port_templates', 'module_type', module_type)
 
     def get_module_rear_ports(self, module_type):
-        return {str(item): item for item in self.netbox.dcim.rear_port_templates.filter(moduletype_id=module_type)}
+        return self.get_existing_components('rear_port_templates', 'module_type', module_type)
 
     def get_device_type_ports_to_create(self, dcim_ports, device_type, existing_ports):
-        to_create = [port for port in dcim_ports if port['name'] not in existing_ports]
-        for port in to_create:
-            port['device_type'] = device_type
-
-        return to_create
+        '''Return the payloads of the templates missing in NetBox, the definition stays unchanged'''
+        return [port.to_dict(device_type=device_type) for port in dcim_ports if port['name'] not in existing_ports]
 
     def get_module_type_ports_to_create(self, module_ports, module_type, existing_ports):
-        to_create = [port for port in module_ports if port['name'] not in existing_ports]
-        for port in to_create:
-            port['module_type'] = module_type
-
-        return to_create
+        return [port.to_dict(module_type=module_type) for port in module_ports if port['name'] not in existing_ports]
 
     def create_interfaces(self, interfaces, device_type):
-        existing_interfaces = {str(item): item for item in self.netbox.dcim.interface_templates.filter(
-            devicetype_id=device_type)}
+        existing_interfaces = self.get_existing_components('interface_templates', 'device_type', device_type)
         to_create = self.get_device_type_ports_to_create(
             interfaces, device_type, existing_interfaces)
+        self.queue_updates('interface_templates', interfaces, existing_interfaces, "Interface")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_device_ports_created(
-                                         self.netbox.dcim.interface_templates.create(to_create), "Interface")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Interface")
+            self.queue_components('interface_templates', to_create, "Interface")
 
     def create_power_ports(self, power_ports, device_type):
         existing_power_ports = self.get_power_ports(device_type)
         to_create = self.get_device_type_ports_to_create(power_ports, device_type, existing_power_ports)
+        self.queue_updates('power_port_templates', power_ports, existing_power_ports, "Power Port")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_device_ports_created(
-                                         self.netbox.dcim.power_port_templates.create(to_create), "Power Port")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Power Port")
+            self.queue_components('power_port_templates', to_create, "Power Port")
 
     def create_console_ports(self, console_ports, device_type):
-        existing_console_ports = {str(item): item for item in self.netbox.dcim.console_port_templates.filter(devicetype_id=device_type)}
+        existing_console_ports = self.get_existing_components('console_port_templates', 'device_type', device_type)
         to_create = self.get_device_type_ports_to_create(console_ports, device_type, existing_console_ports)
+        self.queue_updates('console_port_templates', console_ports, existing_console_ports, "Console Port")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_device_ports_created(
-                                         self.netbox.dcim.console_port_templates.create(to_create), "Console Port")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Console Port")
+            self.queue_components('console_port_templates', to_create, "Console Port")
 
     def create_power_outlets(self, power_outlets, device_type):
-        existing_power_outlets = {str(item): item for item in self.netbox.dcim.power_outlet_templates.filter(devicetype_id=device_type)}
+        existing_power_outlets = self.get_existing_components('power_outlet_templates', 'device_type', device_type)
         to_create = self.get_device_type_ports_to_create(power_outlets, device_type, existing_power_outlets)
+        self.queue_updates('power_outlet_templates', power_outlets, existing_power_outlets, "Power Outlet")
 
         if to_create:
-            existing_power_ports = self.get_power_ports(device_type)
-            for outlet in to_create:
-                try:
-                    power_port = existing_power_ports[outlet["power_port"]]
-                    outlet['power_port'] = power_port.id
-                except KeyError:
-                    pass
-
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_device_ports_created(
-                                         self.netbox.dcim.power_outlet_templates.create(to_create), "Power Outlet")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Power Outlet")
+            self.queue_components('power_outlet_templates', to_create, "Power Outlet")
 
     def create_console_server_ports(self, console_server_ports, device_type):
-        existing_console_server_ports = {str(item): item for item in self.netbox.dcim.console_server_port_templates.filter(devicetype_id=device_type)}
+        existing_console_server_ports = self.get_existing_components('console_server_port_templates', 'device_type', device_type)
         to_create = self.get_device_type_ports_to_create(console_server_ports, device_type, existing_console_server_ports)
+        self.queue_updates('console_server_port_templates', console_server_ports, existing_console_server_ports, "Console Server Port")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_device_ports_created(
-                                         self.netbox.dcim.console_server_port_templates.create(to_create), "Console Server Port")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Console Server Port")
+            self.queue_components('console_server_port_templates', to_create, "Console Server Port")
 
     def create_rear_ports(self, rear_ports, device_type):
         existing_rear_ports = self.get_rear_ports(device_type)
         to_create = self.get_device_type_ports_to_create(rear_ports, device_type, existing_rear_ports)
+        self.queue_updates('rear_port_templates', rear_ports, existing_rear_ports, "Rear Port")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_device_ports_created(
-                                         self.netbox.dcim.rear_port_templates.create(to_create), "Rear Port")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Rear Port")
+            self.queue_components('rear_port_templates', to_create, "Rear Port")
 
     def create_front_ports(self, front_ports, device_type):
-        existing_front_ports = {str(item): item for item in self.netbox.dcim.front_port_templates.filter(devicetype_id=device_type)}
+        existing_front_ports = self.get_existing_components('front_port_templates', 'device_type', device_type)
         to_create = self.get_device_type_ports_to_create(front_ports, device_type, existing_front_ports)
+        self.queue_updates('front_port_templates', front_ports, existing_front_ports, "Front Port")
 
         if to_create:
-            all_rearports = self.get_rear_ports(device_type)
-            for port in to_create:
-                try:
-                    rear_port = all_rearports[port["rear_port"]]
-                    port['rear_port'] = rear_port.id
-                except KeyError:
-                    self.handle.log(f'Could not find Rear Port for Front Port: {port["name"]} - '
-                        + f'{port["type"]} - {device_type}')
-
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_device_ports_created(
-                                         self.netbox.dcim.front_port_templates.create(to_create), "Front Port")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Front Port")
+            self.queue_components('front_port_templates', to_create, "Front Port")
 
     def create_device_bays(self, device_bays, device_type):
-        existing_device_bays = {str(item): item for item in self.netbox.dcim.device_bay_templates.filter(devicetype_id=device_type)}
+        existing_device_bays = self.get_existing_components('device_bay_templates', 'device_type', device_type)
         to_create = self.get_device_type_ports_to_create(device_bays, device_type, existing_device_bays)
+        self.queue_updates('device_bay_templates', device_bays, existing_device_bays, "Device Bay")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_device_ports_created(
-                                         self.netbox.dcim.device_bay_templates.create(to_create), "Device Bay")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Device Bay")
+            self.queue_components('device_bay_templates', to_create, "Device Bay")
 
     def create_module_bays(self, module_bays, device_type):
-        existing_module_bays = {str(item): item for item in self.netbox.dcim.module_bay_templates.filter(devicetype_id=device_type)}
+        existing_module_bays = self.get_existing_components('module_bay_templates', 'device_type', device_type)
         to_create = self.get_device_type_ports_to_create(module_bays, device_type, existing_module_bays)
+        self.queue_updates('module_bay_templates', module_bays, existing_module_bays, "Module Bay")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_device_ports_created(
-                                         self.netbox.dcim.module_bay_templates.create(to_create), "Module Bay")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Module Bay")
+            self.queue_components('module_bay_templates', to_create, "Module Bay")
 
     def create_module_interfaces(self, module_interfaces, module_type):
-        existing_interfaces = {str(item): item for item in self.netbox.dcim.interface_templates.filter(moduletype_id=module_type)}
+        existing_interfaces = self.get_existing_components('interface_templates', 'module_type', module_type)
         to_create = self.get_module_type_ports_to_create(module_interfaces, module_type, existing_interfaces)
+        self.queue_updates('interface_templates', module_interfaces, existing_interfaces, "Module Interface")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_module_ports_created(
-                                         self.netbox.dcim.interface_templates.create(to_create), "Module Interface")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Module Interface")
+            self.queue_components('interface_templates', to_create, "Module Interface")
 
     def create_module_power_ports(self, power_ports, module_type):
         existing_power_ports = self.get_module_power_ports(module_type)
         to_create = self.get_module_type_ports_to_create(power_ports, module_type, existing_power_ports)
+        self.queue_updates('power_port_templates', power_ports, existing_power_ports, "Module Power Port")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_module_ports_created(
-                                         self.netbox.dcim.power_port_templates.create(to_create), "Module Power Port")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Module Power Port")
+            self.queue_components('power_port_templates', to_create, "Module Power Port")
 
     def create_module_console_ports(self, console_ports, module_type):
-        existing_console_ports = {str(item): item for item in self.netbox.dcim.console_port_templates.filter(moduletype_id=module_type)}
+        existing_console_ports = self.get_existing_components('console_port_templates', 'module_type', module_type)
         to_create = self.get_module_type_ports_to_create(console_ports, module_type, existing_console_ports)
+        self.queue_updates('console_port_templates', console_ports, existing_console_ports, "Module Console Port")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_module_ports_created(
-                                         self.netbox.dcim.console_port_templates.create(to_create), "Module Console Port")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Module Console Port")
+            self.queue_components('console_port_templates', to_create, "Module Console Port")
 
     def create_module_power_outlets(self, power_outlets, module_type):
-        existing_power_outlets = {str(item): item for item in self.netbox.dcim.power_outlet_templates.filter(moduletype_id=module_type)}
+        existing_power_outlets = self.get_existing_components('power_outlet_templates', 'module_type', module_type)
         to_create = self.get_module_type_ports_to_create(power_outlets, module_type, existing_power_outlets)
+        self.queue_updates('power_outlet_templates', power_outlets, existing_power_outlets, "Module Power Outlet")
 
         if to_create:
-            existing_power_ports = self.get_module_power_ports(module_type)
-            for outlet in to_create:
-                try:
-                    power_port = existing_power_ports[outlet["power_port"]]
-                    outlet['power_port'] = power_port.id
-                except KeyError:
-                    pass
-
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_module_ports_created(
-                                         self.netbox.dcim.power_outlet_templates.create(to_create), "Module Power Outlet")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Module Power Outlet")
+            self.queue_components('power_outlet_templates', to_create, "Module Power Outlet")
 
     def create_module_console_server_ports(self, console_server_ports, module_type):
-        existing_console_server_ports = {str(item): item for item in self.netbox.dcim.console_server_port_templates.filter(moduletype_id=module_type)}
+        existing_console_server_ports = self.get_existing_components('console_server_port_templates', 'module_type', module_type)
         to_create = self.get_module_type_ports_to_create(console_server_ports, module_type, existing_console_server_ports)
+        self.queue_updates('console_server_port_templates', console_server_ports, existing_console_server_ports, "Module Console Server Port")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_module_ports_created(
-                                         self.netbox.dcim.console_server_port_templates.create(to_create), "Module Console Server Port")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Module Console Server Port")
+            self.queue_components('console_server_port_templates', to_create, "Module Console Server Port")
 
     def create_module_rear_ports(self, rear_ports, module_type):
         existing_rear_ports = self.get_module_rear_ports(module_type)
         to_create = self.get_module_type_ports_to_create(rear_ports, module_type, existing_rear_ports)
+        self.queue_updates('rear_port_templates', rear_ports, existing_rear_ports, "Module Rear Port")
 
         if to_create:
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_module_ports_created(
-                                         self.netbox.dcim.rear_port_templates.create(to_create), "Module Rear Port")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Module Rear Port")
+            self.queue_components('rear_port_templates', to_create, "Module Rear Port")
 
     def create_module_front_ports(self, front_ports, module_type):
-        existing_front_ports = {str(item): item for item in self.netbox.dcim.front_port_templates.filter(moduletype_id=module_type)}
+        existing_front_ports = self.get_existing_components('front_port_templates', 'module_type', module_type)
         to_create = self.get_module_type_ports_to_create(front_ports, module_type, existing_front_ports)
+        self.queue_updates('front_port_templates', front_ports, existing_front_ports, "Module Front Port")
 
         if to_create:
-            existing_rear_ports = self.get_module_rear_ports(module_type)
-            for port in to_create:
-                try:
-                    rear_port = existing_rear_ports[port["rear_port"]]
-                    port['rear_port'] = rear_port.id
-                except KeyError:
-                    self.handle.log(f'Could not find Rear Port for Front Port: {port["name"]} - '
-                        + f'{port["type"]} - {module_type}')
-
-            try:
-                self.counter.update({'updated':
-                                     self.handle.log_module_ports_created(
-                                         self.netbox.dcim.front_port_templates.create(to_create), "Module Front Port")
-                                     })
-            except pynetbox.RequestError as excep:
-                self.handle.log(f"Error '{excep.error}' creating Module Front Port")
+            self.queue_components('front_port_templates', to_create, "Module Front Port")
 
     def upload_images(self,baseurl,token,images,device_type):
         '''Upload front_image and/or rear_image for the given device type
@@ -473,13 +984,20 @@ class DeviceTypes:
         device_type: id for the device-type to update
 
         Returns:
-        None
+        True if NetBox accepted the images
         '''
         url = f"{baseurl}/api/dcim/device-types/{device_type}/"
-        headers = { "Authorization": f"Token {token}" }
+        body = MultipartStream(images)
+        headers = { "Authorization": f"Token {token}", "Content-Type": body.content_type }
 
-        files = { i: (os.path.basename(f), open(f,"rb") ) for i,f in images.items() }
-        response = requests.patch(url, headers=headers, files=files, verify=(not self.ignore_ssl))
+        try:
+            response = self.netbox.http_session.patch(url, headers=headers, data=body)
+        finally:
+            body.close()
 
         self.handle.log( f'Images {images} updated at {url}: {response}' )
-        self.counter["images"] += len(images)
+        if not response.ok:
+            self.failed_parents.add(('device_type', device_type))
+            return False
+        self.counter.update({'images': len(images)})
+        return True
@@ -0,0 +1,259 @@
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
+import hashlib
+import json
+import os
+
+from atomic_file import write_atomically
+
+# Endpoints kept, with the fields of their brief representation the import needs
+ENDPOINTS = {
+    'manufacturers': ('name', 'slug'),
+    'device_types': ('manufacturer', 'model'),
+    'module_types': ('manufacturer', 'model'),
+}
+# Bytes of repeated id parameters per filter request. Gunicorn rejects
+# request lines over 4094 bytes, and the next links of NetBox repeat the
+# whole query, so about 100 ids are sent at a time.
+FILTER_QUERY_SIZE = 2000
+
+
+def chunk_ids(name, ids, size=FILTER_QUERY_SIZE):
+    '''Split ids, in order, into lists whose name=id query parameters fit into size bytes'''
+    chunk, used = [], 0
+    for object_id in sorted(ids):
+        length = len(name) + len(str(object_id)) + 2
+        if chunk and used + length > size:
+            yield chunk
+            chunk, used = [], 0
+        chunk.append(object_id)
+        used += length
+    if chunk:
+        yield chunk
+
+
+class RemoteState:
+    '''Local copy of the NetBox objects the import looks up: manufacturers, device and module types
+
+    Stored per NetBox together with the time it was last brought up to
+    date, as told by NetBox's clock. Device and module types are only kept
+    for the manufacturers being imported. A refresh only fetches the
+    objects changed since then, with last_updated__gte, and compares the
+    number of objects NetBox has with the copy. Only if they differ, e.g.
+    after a deletion, are the ids listed to find the objects deleted or
+    missed, and the types of a manufacturer new to the import are listed.
+    '''
+
+    def __new__(cls, *args, **kwargs):
+        return super().__new__(cls)
+
+    def __init__(self, path, target, handle):
+        self.path = path
+        self.target = target
+        self.handle = handle
+        self.version = 2
+        # Objects changed around the high-water mark are fetched again, covers clock and request skew
+        self.overlap = timedelta(minutes=1)
+        self.updated = {}
+        # {endpoint: {id: {field: value}}}
+        self.objects = {endpoint: {} for endpoint in ENDPOINTS}
+        # {endpoint: set of the manufacturer ids whose types are in the copy}
+        self.scopes = {}
+        self.load()
+
+    @staticmethod
+    def get_path(cache_path, target):
+        '''Return the state file of one NetBox below cache_path, or None without a cache'''
+        if not cache_path:
+            return None
+        return os.path.join(cache_path, 'remote-state',
+                            f'{hashlib.sha256(target.encode()).hexdigest()[:16]}.json')
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as stream:
+                state = json.load(stream)
+        except (OSError, ValueError) as state_error:
+            self.handle.verbose_log("Ignoring unreadable NetBox state: %s", state_error)
+            return
+        if state.get('version') != self.version or state.get('target') != self.target:
+            return
+        self.updated = state['updated']
+        self.scopes = {endpoint: set(manufacturer_ids) for endpoint, manufacturer_ids in state['scopes'].items()}
+        for endpoint, objects in state['objects'].items():
+            self.objects[endpoint] = {int(object_id): fields for object_id, fields in objects.items()}
+
+    def save(self):
+        if not self.path:
+            return
+        write_atomically(self.path, lambda stream: json.dump(
+            {'version': self.version, 'target': self.target, 'updated': self.updated, 'objects': self.objects,
+             'scopes': {endpoint: sorted(manufacturer_ids) for endpoint, manufacturer_ids in self.scopes.items()}},
+            stream))
+
+    def fetch(self, netbox, endpoint, limit, pages=True, **filters):
+        '''List endpoint in brief form
+
+        Requested directly rather than through pynetbox, for the Date header
+        of the response. With pages=False only the first page is fetched,
+        with a fields filter only those fields instead of the brief form.
+
+        Returns:
+        (number of matching objects, their JSON, the time NetBox answered the first request or None)
+        '''
+        url = f"{netbox.base_url}/dcim/{endpoint.replace('_', '-')}/"
+        params = dict(filters, limit=limit)
+        if 'fields' not in filters:
+            params['brief'] = 1
+        results, answered = [], None
+        while url:
+            response = netbox.http_session.get(url, params=params, headers={
+                'Authorization': f'Token {netbox.token}', 'Accept': 'application/json'})
+            response.raise_for_status()
+            if answered is None:
+                try:
+                    answered = parsedate_to_datetime(response.headers['Date'])
+                except (KeyError, TypeError, ValueError):
+                    pass
+            page = response.json()
+            results.extend(page['results'])
+            # The next link carries the query
+            url, params = (page['next'] if pages else None), None
+        return page['count'], results, answered
+
+    def query(self, netbox, endpoint, limit, manufacturer_ids=None, pages=True, **filters):
+        '''fetch() the objects of some manufacturers, in chunks of ids, or of all with manufacturer_ids=None
+
+        Returns:
+        (number of matching objects, their JSON, the time NetBox answered the first request or None)
+        '''
+        chunks = [None] if manufacturer_ids is None else chunk_ids('manufacturer_id', manufacturer_ids)
+        count, results, answered = 0, [], None
+        for chunk in chunks:
+            chunk_filters = filters if chunk is None else dict(filters, manufacturer_id=chunk)
+            chunk_count, chunk_results, chunk_answered = self.fetch(netbox, endpoint, limit, pages, **chunk_filters)
+            count += chunk_count
+            results.extend(chunk_results)
+            answered = answered or chunk_answered
+        return count, results, answered
+
+    def refresh(self, netbox, page_size=1000, endpoints=ENDPOINTS, manufacturer_slugs=None):
+        '''Bring the copy of endpoints up to date and save it
+
+        Args:
+        manufacturer_slugs: manufacturers whose device and module types are kept, None for all
+        '''
+        # Time of the first answer of NetBox, marks an endpoint that needs no request
+        answered = None
+        for endpoint in endpoints:
+            scope = None
+            if endpoint != 'manufacturers' and manufacturer_slugs is not None:
+                scope = {object_id for object_id, fields in self.objects['manufacturers'].items()
+                         if fields['slug'] in manufacturer_slugs}
+            answered = self.refresh_endpoint(netbox, endpoint, page_size, answered, scope)
+        try:
+            self.save()
+        except OSError as state_error:
+            self.handle.verbose_log("Could not write NetBox state: %s", state_error)
+
+    def refresh_endpoint(self, netbox, endpoint, page_size, answered=None, scope=None):
+        '''Bring the copy of one endpoint up to date
+
+        The high-water mark is set from the Date of NetBox's first answer, so
+        a local clock ahead of NetBox's cannot skip changes.
+
+        Args:
+        scope: ids of the manufacturers whose types are kept, None for every object
+
+        Returns:
+        the time NetBox answered first, or answered if no request was needed
+        '''
+        objects = self.objects[endpoint]
+        since = self.updated.get(endpoint)
+        if since is None:
+            objects.clear()
+        # Manufacturers whose types the copy holds, the types of others in scope are listed
+        known = None
+        if scope is not None:
+            known = (self.scopes.get(endpoint, set()) & scope) if since is not None else set()
+            for object_id, fields in list(objects.items()):
+                if fields['manufacturer'] not in known:
+                    del objects[object_id]
+        changes = deleted = 0
+        if since is not None and known != set():
+            count, _, first = self.query(netbox, endpoint, 1, known, pages=False)
+            answered = answered or first
+            _, changed, _ = self.query(netbox, endpoint, page_size, known, last_updated__gte=since)
+            for item in changed:
+                self.add(endpoint, item)
+            changes = len(changed)
+            # Every object changed since the mark is in the copy now. A larger
+            # copy holds deleted objects, a smaller one missed some changes.
+            if len(objects) != count:
+                ids = {item['id'] for item in self.query(netbox, endpoint, page_size, known, fields='id')[1]}
+                for object_id in set(objects) - ids:
+                    del objects[object_id]
+                    deleted += 1
+                missed = ids - set(objects)
+                for chunk in chunk_ids('id', missed):
+                    for item in self.fetch(netbox, endpoint, page_size, id=chunk)[1]:
+                        self.add(endpoint, item)
+                changes += len(missed)
+        listed = None if scope is None else scope - known
+        if listed or (scope is None and since is None):
+            _, items, first = self.query(netbox, endpoint, page_size, listed)
+            answered = answered or first
+            for item in items:
+                self.add(endpoint, item)
+            changes += len(items)
+        if answered is not None:
+            self.updated[endpoint] = (answered - self.overlap).isoformat(timespec='seconds')
+            if scope is not None:
+                self.scopes[endpoint] = set(scope)
+        else:
+            # Nothing to date the copy with, the next refresh loads it in full
+            self.updated.pop(endpoint, None)
+        if since is None:
+            listed_note = ', loaded in full'
+        else:
+            listed_note = f', types of {len(listed)} more manufacturers listed' if listed else ''
+        self.handle.verbose_log('NetBox state of %s: %s objects, %s changed, %s deleted%s', endpoint, len(objects),
+                                changes, deleted, listed_note)
+        return answered
+
+    def load_manufacturers(self, netbox, endpoint, manufacturer_ids, page_size=1000):
+        '''List the device or module types of manufacturers the copy does not hold yet'''
+        missing = set(manufacturer_ids) - self.scopes.get(endpoint, set())
+        if not missing:
+            return
+        for item in self.query(netbox, endpoint, page_size, missing)[1]:
+            self.add(endpoint, item)
+        self.scopes.setdefault(endpoint, set()).update(missing)
+
+    def add(self, endpoint, item):
+        '''Add or update an object from its JSON, brief or not'''
+        fields = {field: item.get(field) for field in ENDPOINTS[endpoint]}
+        if fields.get('manufacturer') is not None:
+            fields['manufacturer'] = fields['manufacturer']['id']
+        self.objects[endpoint][item['id']] = fields
+        if endpoint == 'manufacturers':
+            # A manufacturer created by the import has no types yet
+            for manufacturer_ids in self.scopes.values():
+                manufacturer_ids.add(item['id'])
+
+    def get_ids(self, endpoint):
+        return set(self.objects[endpoint])
+
+    def get_manufacturers(self):
+        '''Return {name: {'id', 'name', 'slug'}} of the manufacturers'''
+        return {fields['name']: dict(fields, id=object_id)
+                for object_id, fields in self.objects['manufacturers'].items()}
+
+    def get_types(self, endpoint, manufacturer_ids):
+        '''Return {(manufacturer slug, model): id} of the device or module types of some manufacturers'''
+        manufacturers = self.objects['manufacturers']
+        return {(manufacturers[fields['manufacturer']]['slug'], fields['model']): object_id
+                for object_id, fields in self.objects[endpoint].items()
+                if fields['manufacturer'] in manufacturer_ids and fields['manufacturer'] in manufacturers}
@@ -1,24 +1,215 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import json
 import os
+import pickle
+import queue
+import shutil
+import tarfile
+import threading
 from glob import glob
-from re import sub as re_sub
+from re import MULTILINE, compile as re_compile, sub as re_sub
 from git import Repo, exc
 import yaml
 
+from atomic_file import write_atomically
+from models import Definition
+from shards import get_shard
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+INDEX_FIELDS = ('manufacturer', 'model', 'slug', 'part_number')
+INDEX_PATTERN = re_compile(r'^(manufacturer|model|slug|part_number):[ \t]*(.*?)[ \t]*\r?$', MULTILINE)
+
+
+def slug_format(name):
+    return re_sub('\W+', '-', name.lower())
+
+
+def scan_definition(file):
+    '''Read the identifying top-level fields of a definition without parsing it
+
+    Only plain and quoted single-line scalars are understood. If any other
+    value is found, 'complete' is False and callers must parse the file to
+    know its fields.
+    '''
+    fields = dict.fromkeys(INDEX_FIELDS)
+    fields['complete'] = True
+    with open(file, 'r') as stream:
+        for key, value in INDEX_PATTERN.findall(stream.read()):
+            if not value or value[0] in '&*!|>{[@`%#' or fields[key] is not None \
+                    or (value[0] in '"\'' and (len(value) < 2 or value[-1] != value[0] or '\\' in value)):
+                fields['complete'] = False
+                continue
+            if value[0] in '"\'':
+                value = value[1:-1].replace("''", "'") if value[0] == "'" else value[1:-1]
+            else:
+                value = value.split(' #', 1)[0].rstrip()
+            fields[key] = value
+    return fields
+
+
+def parse_file(file):
+    '''Parse and normalize one YAML definition
+
+    Returns:
+    (data, None) on success, (None, error) if the file is not valid YAML
+    '''
+    with open(file, 'r') as stream:
+        try:
+            data = yaml.load(stream, Loader=SafeLoader)
+        except yaml.YAMLError as excep:
+            return None, str(excep)
+    manufacturer = data['manufacturer']
+    data['manufacturer'] = {
+        'name': manufacturer, 'slug': slug_format(manufacturer)}
+
+    # Save file location to resolve any relative paths for images
+    data['src'] = file
+    return data, None
+
+
+def parse_file_chunk(files):
+    return [parse_file(file) for file in files]
+
+
+def start_parse_pool(workers):
+    '''Start the processes that parse the YAML files, or return None to parse in this process
+
+    Call it before any thread is started: a child forked while another
+    thread holds a lock, e.g. of the allocator or the log writer, can
+    deadlock. All workers are forked right away and kept for the whole
+    run, so a daemon reuses them for every sync.
+    '''
+    # Worker processes must not re-import the entry script (and with it
+    # settings.py), so only the fork start method is used.
+    if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    # The first task forks every worker, before the pool starts its own management thread
+    pool.submit(int).result()
+    return pool
+
+
+class FanOut:
+    '''Feed the items of an iterable to several consumers from a background thread
+
+    Each consumer gets the items its selector accepts, through a queue of
+    at most size items, so the slowest consumer paces the producer and the
+    others overlap with it. The items are immutable Definitions, every
+    consumer gets the same object. The producer starts when the first
+    consumer asks for an item. Exceptions of the producer are raised in
+    every consumer.
+    '''
+
+    def __new__(cls, *args, **kwargs):
+        return super().__new__(cls)
+
+    def __init__(self, iterable, selectors, size):
+        self.iterable = iterable
+        self.selectors = selectors
+        self.queues = [queue.Queue(maxsize=size) for _ in selectors]
+        self.closed = [False] * len(selectors)
+        self.done = object()
+        self.lock = threading.Lock()
+        self.producer = None
+
+    def start(self):
+        with self.lock:
+            if self.producer is None:
+                self.producer = threading.Thread(target=self.produce, name='fan-out', daemon=True)
+                self.producer.start()
+
+    def put(self, index, entry):
+        # A consumer that stopped early must not hold up the others
+        while not self.closed[index]:
+            try:
+                self.queues[index].put(entry, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def produce(self):
+        error = None
+        try:
+            for item in self.iterable:
+                accepted = [index for index, selector in enumerate(self.selectors)
+                            if not self.closed[index] and selector(item)]
+                for index in accepted:
+                    self.put(index, (item, None))
+        except BaseException as producer_error:
+            error = producer_error
+        for index in range(len(self.queues)):
+            self.put(index, (self.done, error))
+
+    def consume(self, index):
+        '''Yield the items for consumer index'''
+        self.start()
+        try:
+            while True:
+                item, error = self.queues[index].get()
+                if error is not None:
+                    raise error
+                if item is self.done:
+                    return
+                yield item
+        finally:
+            self.close(index)
+
+    def close(self, index):
+        '''Stop feeding consumer index, e.g. when it does not need the items after all'''
+        self.closed[index] = True
+
 
 class DTLRepo:
     def __new__(cls, *args, **kwargs):
         return super().__new__(cls)
 
-    def __init__(self, args, repo_path, exception_handler):
+    def __init__(self, args, repo_path, exception_handler, cache_path=None, parse_cache_size=50000, parse_pool=None):
+        '''
+        Args:
+        parse_pool: process pool from start_parse_pool, None to parse in this process
+        '''
         self.handle = exception_handler
         self.yaml_extensions = ['yaml', 'yml']
         self.url = args.url
         self.repo_path = repo_path
         self.branch = args.branch
+        self.parse_workers = args.parse_workers
+        self.parse_pool = parse_pool
+        self.parse_chunk_size = 64
+        self.parse_cache_file = os.path.join(cache_path, 'parse-cache.pickle') if cache_path else None
+        self.parse_cache_size = parse_cache_size
+        self.parse_cache_version = 1
+        # Kept in memory once loaded, a long-running process reads the file only once
+        self.parse_cache = None
+        self.import_state_file = os.path.join(cache_path, 'import-state.json') if cache_path else None
+        # Imports into several NetBox instances record their state concurrently
+        self.state_lock = threading.Lock()
+        # GitPython talks to one git cat-file process per repository, which must not be shared between threads
+        self.git_lock = threading.Lock()
+        self.index_file = os.path.join(cache_path, 'repo-index.json') if cache_path else None
+        self.index_version = 1
+        self.index = None
         self.repo = None
         self.cwd = os.getcwd()
+        self.depth = args.depth
+        self.filter = args.filter
+        # Sparse checkout only narrows anything when vendors were selected
+        self.sparse = args.sparse and bool(args.vendors)
+        self.vendors = args.vendors
+        self.sparse_folders = []
+        # (index, count) of the vendors this process imports, see --shard
+        self.shard = args.shard
 
-        if os.path.isdir(self.repo_path):
+        if args.snapshot:
+            self.load_snapshot(args.snapshot, cache_path)
+        elif os.path.isdir(self.repo_path):
             self.pull_repo()
         else:
             self.clone_repo()
@@ -36,7 +227,7 @@ class DTLRepo:
         return os.path.join(self.get_absolute_path(), 'module-types')
 
     def slug_format(self, name):
-        return re_sub('\W+', '-', name.lower())
+        return slug_format(name)
 
     def pull_repo(self):
         try:
@@ -46,10 +237,8 @@ class DTLRepo:
             if not self.repo.remotes.origin.url.endswith('.git'):
                 self.handle.exception("GitInvalidRepositoryError", self.repo.remotes.origin.url,
                                       f"Origin URL {self.repo.remotes.origin.url} does not end with .git")
-            self.repo.remotes.origin.pull()
-            self.repo.git.checkout(self.branch)
-            self.handle.verbose_log(
-                f"Pulled Repo {self.repo.remotes.origin.url}")
+            self.update_checkout()
+            self.handle.verbose_log("Pulled Repo %s", self.repo.remotes.origin.url)
         except exc.GitCommandError as git_error:
             self.handle.exception(
                 "GitCommandError", self.repo.remotes.origin.url, git_error)
@@ -57,10 +246,65 @@ class DTLRepo:
             self.handle.exception(
                 "Exception", 'Git Repository Error', git_error)
 
+    def update_checkout(self):
+        if self.depth or self.filter or self.sparse or self.is_sparse():
+            self.fetch_repo()
+        else:
+            self.repo.remotes.origin.pull()
+            self.repo.git.checkout(self.branch)
+
+    def update(self):
+        '''Pull the library again in a long-running process
+
+        A failed pull is logged and the current checkout kept, the next
+        update tries again. A snapshot is never updated.
+
+        Returns:
+        True if HEAD moved
+        '''
+        if self.repo is None:
+            return False
+        before = self.get_head_commit()
+        try:
+            self.update_checkout()
+        except exc.GitCommandError as git_error:
+            self.handle.log(f"Could not update {self.url}: {git_error}")
+            return False
+        if self.get_head_commit() == before:
+            return False
+        # The index belongs to the commit it was built from
+        self.index = None
+        self.handle.verbose_log("Pulled %s..%s", before[:12], self.get_head_commit()[:12])
+        return True
+
+    def fetch_repo(self):
+        '''Update a shallow, partial or sparse clone to the tip of the branch
+
+        A merging pull can fail on shallow history, the branch is reset to
+        the fetched commit instead. Commits fetched earlier stay in the
+        object store, so the incremental import can still diff against them.
+        '''
+        fetch_args = {'depth': self.depth} if self.depth else {}
+        if self.filter:
+            fetch_args['filter'] = self.filter
+        self.repo.git.fetch('origin', f'+refs/heads/{self.branch}:refs/remotes/origin/{self.branch}', **fetch_args)
+        self.set_sparse_checkout(f'origin/{self.branch}')
+        self.repo.git.checkout('--force', '-B', self.branch, f'origin/{self.branch}')
+
     def clone_repo(self):
         try:
+            clone_args = {'branch': self.branch}
+            if self.depth:
+                clone_args['depth'] = self.depth
+            if self.filter:
+                clone_args['filter'] = self.filter
+            if self.sparse:
+                clone_args['no_checkout'] = True
             self.repo = Repo.clone_from(
-                self.url, self.get_absolute_path(), branch=self.branch)
+                self.url, self.get_absolute_path(), **clone_args)
+            if self.sparse:
+                self.set_sparse_checkout('HEAD')
+                self.repo.git.checkout(self.branch)
             self.handle.log(
                 f"Package Installed {self.repo.remotes.origin.url}")
         except exc.GitCommandError as git_error:
@@ -69,38 +313,441 @@ class DTLRepo:
             self.handle.exception(
                 "Exception", 'Git Repository Error', git_error)
 
-    def get_devices(self, base_path, vendors: list = None):
+    def is_sparse(self):
+        # git sparse-checkout may keep the setting in the per-worktree config, only git reads all of them
+        try:
+            return self.repo.git.config('--get', '--bool', 'core.sparseCheckout') == 'true'
+        except exc.GitCommandError:
+            return False
+
+    def set_sparse_checkout(self, commit):
+        '''Limit the checkout to the folders of the selected vendors, or lift the limit
+
+        Vendors are matched case-insensitively against the folder names in
+        the commit, which are read from the tree without checking it out.
+        '''
+        if not self.sparse:
+            if self.is_sparse():
+                self.repo.git.sparse_checkout('disable')
+            return
+
+        folders = []
+        for kind in ('device-types', 'module-types', 'elevation-images'):
+            listing = self.repo.git.ls_tree('-d', '--name-only', '-z', commit, f'{kind}/')
+            folders.extend(path for path in listing.split('\0')
+                           if path and os.path.basename(path).casefold() in self.vendors)
+        self.repo.git.sparse_checkout('set', '--cone', *folders)
+        self.sparse_folders = sorted(folders)
+        self.handle.verbose_log("Sparse checkout of %s vendor folders", len(folders))
+
+    def load_snapshot(self, snapshot, cache_path=None):
+        '''Use a library snapshot without git: a directory, or a tarball extracted to the cache
+
+        Without git there is no commit to compare against, every run checks
+        all files and relies on the sync manifest to skip unchanged ones.
+        '''
+        if os.path.isdir(snapshot):
+            self.repo_path = os.path.abspath(snapshot)
+        else:
+            target = os.path.join(os.path.abspath(cache_path or os.path.dirname(self.get_absolute_path())),
+                                  'snapshot')
+            try:
+                shutil.rmtree(target, ignore_errors=True)
+                with tarfile.open(snapshot) as archive:
+                    for member in archive.getmembers():
+                        path = os.path.realpath(os.path.join(target, member.name))
+                        if not path.startswith(os.path.realpath(target) + os.sep) \
+                                or member.issym() or member.islnk() or member.isdev():
+                            self.handle.exception("Exception", 'Snapshot Error',
+                                                  f'Refusing to extract {member.name} from {snapshot}')
+                    if hasattr(tarfile, 'data_filter'):
+                        archive.extractall(target, filter='data')
+                    else:
+                        archive.extractall(target)
+            except (OSError, tarfile.TarError) as snapshot_error:
+                self.handle.exception("Exception", 'Snapshot Error', snapshot_error)
+            self.repo_path = target
+            # Archives of a repository usually wrap it in one top-level folder
+            entries = os.listdir(target)
+            if len(entries) == 1 and os.path.isdir(os.path.join(target, entries[0])) \
+                    and not os.path.isdir(os.path.join(target, 'device-types')):
+                self.repo_path = os.path.join(target, entries[0])
+        if not os.path.isdir(os.path.join(self.repo_path, 'device-types')):
+            self.handle.exception("Exception", 'Snapshot Error',
+                                  f'{snapshot} does not contain a device-types folder')
+        self.handle.log(f"Using snapshot {snapshot}")
+
+    def get_head_commit(self):
+        if not self.repo:
+            return None
+        with self.git_lock:
+            return self.repo.head.commit.hexsha
+
+    def load_import_state(self):
+        if not self.import_state_file or not os.path.isfile(self.import_state_file):
+            return {}
+        try:
+            with open(self.import_state_file, 'r') as stream:
+                return json.load(stream)
+        except (OSError, ValueError) as state_error:
+            self.handle.verbose_log("Ignoring unreadable import state: %s", state_error)
+            return {}
+
+    def get_state_key(self, target):
+        '''Each shard covers different vendors and keeps its own last import'''
+        return f'{target} shard {self.shard[0]}/{self.shard[1]}' if self.shard else target
+
+    def get_last_import(self, target):
+        '''Return (commit, files to retry, commit of the module types) of the last successful import into target
+
+        The module types are only imported into a NetBox with module
+        support, their commit stays behind while it has none.
+        '''
+        state = self.load_import_state().get(self.get_state_key(target), {})
+        retry = [os.path.join(self.get_absolute_path(), path) for path in state.get('retry', [])]
+        return state.get('commit'), retry, state.get('module_commit', state.get('commit'))
+
+    def save_last_import(self, target, commit, retry: list = None, modules=True):
+        '''Record a successful import into target, of its module types too if modules'''
+        if not self.import_state_file or not commit:
+            return
+        with self.state_lock:
+            self.write_last_import(target, commit, retry, modules)
+
+    def write_last_import(self, target, commit, retry, modules=True):
+        state = self.load_import_state()
+        key = self.get_state_key(target)
+        state[key] = {
+            'commit': commit,
+            'module_commit': commit if modules else state.get(key, {}).get('module_commit'),
+            'retry': sorted(os.path.relpath(path, self.get_absolute_path()) for path in retry or []),
+        }
+        write_atomically(self.import_state_file, lambda stream: json.dump(state, stream, indent=2))
+
+    def get_changed_files(self, since):
+        '''Return absolute paths added, modified or renamed between since and HEAD
+
+        Returns None when since is not known to the clone, e.g. after a force
+        push upstream, so the caller falls back to a full import.
+        '''
+        if not self.repo or not since:
+            return None
+        try:
+            self.repo.commit(since)
+            changed = self.repo.git.diff('--name-only', '--diff-filter=AMR', '-z', since, 'HEAD')
+        except (ValueError, exc.GitCommandError) as git_error:
+            self.handle.verbose_log("Cannot diff against %s: %s", since, git_error)
+            return None
+        return {os.path.join(self.repo.working_tree_dir, path) for path in changed.split('\0') if path}
+
+    def filter_changed_files(self, files: list, changed: set, images: bool = True):
+        '''Keep files that changed, or whose elevation images changed'''
+        selected = [file for file in files if os.path.abspath(file) in changed]
+        if not images:
+            return selected
+
+        # Images are named after the slug, which the index maps back to the definition
+        image_slugs = {}
+        for path in changed:
+            parts = path.split(os.sep)
+            if len(parts) > 2 and parts[-3] == 'elevation-images':
+                image_slugs.setdefault(parts[-2], set()).add(os.path.basename(path).split('.')[0])
+        listed = set(files) - set(selected)
+        unknown = []
+        for vendor, slugs in image_slugs.items():
+            for file, entry in self.get_indexed_files('device-types', vendor):
+                if file not in listed:
+                    continue
+                if not entry['complete']:
+                    unknown.append(file)
+                elif entry['slug'] in slugs:
+                    selected.append(file)
+        for data, error in self.parse_cached(unknown):
+            if data and data.get('slug') in image_slugs[os.path.basename(os.path.dirname(data['src']))]:
+                selected.append(data['src'])
+        return selected
+
+    def get_images(self, vendors: list = None):
+        '''Index elevation images with one directory scan
+
+        Returns:
+        {(vendor folder, slug): {'front_image': path, 'rear_image': path}}
+        '''
+        images = {}
+        base_path = os.path.join(self.get_absolute_path(), 'elevation-images')
+        if not os.path.isdir(base_path):
+            return images
+        for vendor in os.scandir(base_path):
+            if not vendor.is_dir() or (vendors and vendor.name.casefold() not in vendors):
+                continue
+            for image in os.scandir(vendor.path):
+                # Images are named <slug>.<front|rear>.<extension>
+                parts = image.name.split('.')
+                if len(parts) < 3 or parts[-2] not in ('front', 'rear'):
+                    continue
+                side = f'{parts[-2]}_image'
+                # Keep the first match in name order, like the former glob lookup
+                current = images.setdefault((vendor.name, '.'.join(parts[:-2])), {})
+                if side not in current or image.path < current[side]:
+                    current[side] = image.path
+        return images
+
+    def load_index(self):
+        if not self.index_file or not os.path.isfile(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, 'r') as stream:
+                stored = json.load(stream)
+        except (OSError, ValueError) as index_error:
+            self.handle.verbose_log("Ignoring unreadable repository index: %s", index_error)
+            return {}
+        return stored if stored.get('version') == self.index_version else {}
+
+    def get_index(self):
+        '''Map every definition file to its manufacturer, model, slug and part number
+
+        The index is stored per commit and sparse checkout. While neither
+        changes, filtered imports resolve their files from it without
+        listing or reading the library. After a pull only files with a new
+        blob are scanned again.
+
+        Returns:
+        {path relative to the repository: {field: value or None, 'key': cache key}}
+        '''
+        if self.index is not None:
+            return self.index
+        commit = self.get_head_commit()
+        stored = self.load_index()
+        if commit and stored.get('commit') == commit and stored.get('sparse', []) == self.sparse_folders:
+            self.index = stored['files']
+            return self.index
+
+        root = self.get_absolute_path()
+        files = []
+        for kind in ('device-types', 'module-types'):
+            for extension in self.yaml_extensions:
+                files.extend(glob(os.path.join(root, kind, '*', f'*.{extension}')))
+        keys = self.get_cache_keys(files)
+        previous = stored.get('files', {})
+        self.index = {}
+        for file, key in zip(files, keys):
+            path = os.path.relpath(file, root)
+            entry = previous.get(path)
+            if entry is None or entry['key'] != key:
+                entry = dict(scan_definition(file), key=key)
+            self.index[path] = entry
+        self.handle.verbose_log("Indexed %s definitions", len(self.index))
+
+        # Local modifications are keyed by mtime, the index would go stale under the same commit
+        if self.index_file and commit and all(entry['key'].startswith('blob:') for entry in self.index.values()):
+            write_atomically(self.index_file, lambda stream: json.dump(
+                {'version': self.index_version, 'commit': commit, 'sparse': self.sparse_folders,
+                 'files': self.index}, stream))
+        return self.index
+
+    def get_indexed_files(self, kind: str, vendor: str = None):
+        '''Yield (absolute path, index entry) of the definitions of one kind, optionally of one vendor folder'''
+        root = self.get_absolute_path()
+        for path, entry in self.get_index().items():
+            parts = path.split(os.sep)
+            if len(parts) == 3 and parts[0] == kind and (vendor is None or parts[1] == vendor):
+                yield os.path.join(root, path), entry
+
+    def get_devices(self, base_path, vendors: list = None, slugs: list = None, shard: tuple = None):
+        '''Return the definition files below base_path and the vendors they belong to
+
+        Vendor and slug filters are resolved through the repository index,
+        so only the selected files are parsed afterwards. Files the index
+        could not fully read are kept for parse_files to filter. With a
+        shard (index, count), only the vendors of that shard are returned.
+        '''
         files = []
         discovered_vendors = []
-        vendor_dirs = os.listdir(base_path)
+        by_vendor = {}
+        for file, entry in self.get_indexed_files(os.path.basename(os.path.normpath(base_path))):
+            by_vendor.setdefault(os.path.basename(os.path.dirname(file)), []).append((file, entry))
 
-        for folder in [vendor for vendor in vendor_dirs if not vendors or vendor.casefold() in vendors]:
+        for folder in sorted(vendor for vendor in by_vendor if not vendors or vendor.casefold() in vendors):
+            if shard and get_shard(self.slug_format(folder), shard[1]) != shard[0]:
+                continue
             if folder.casefold() != "testing":
                 discovered_vendors.append({'name': folder,
                                            'slug': self.slug_format(folder)})
-                for extension in self.yaml_extensions:
-                    files.extend(glob(base_path + folder + f'/*.{extension}'))
+                for file, entry in by_vendor[folder]:
+                    if slugs and entry['complete'] \
+                            and not any(s.casefold() in (entry['slug'] or '').casefold() for s in slugs):
+                        continue
+                    files.append(file)
         return files, discovered_vendors
 
     def parse_files(self, files: list, slugs: list = None):
-        deviceTypes = []
+        '''Yield the parsed definitions of files as immutable Definitions, as they are parsed'''
+        for data, error in self.parse_cached(sorted(files)):
+            if error:
+                self.handle.verbose_log(error)
+                continue
+
+            if slugs and True not in [True if s.casefold() in data.get('slug', '').casefold() else False for s in slugs]:
+                self.handle.verbose_log("Skipping %s", data['model'])
+                continue
+
+            yield Definition(data)
+
+    def get_definition_keys(self, files: list):
+        '''Return the manufacturer slugs and (manufacturer slug, model) keys of files, from the index
+
+        Lets existing objects be looked up before the files are parsed.
+        Files the index could not fully read only contribute their folder
+        as manufacturer.
+        '''
+        index = self.get_index()
+        root = self.get_absolute_path()
+        manufacturers, keys = set(), set()
         for file in files:
-            with open(file, 'r') as stream:
-                try:
-                    data = yaml.safe_load(stream)
-                except yaml.YAMLError as excep:
-                    self.handle.verbose_log(excep)
-                    continue
-                manufacturer = data['manufacturer']
-                data['manufacturer'] = {
-                    'name': manufacturer, 'slug': self.slug_format(manufacturer)}
+            entry = index.get(os.path.relpath(file, root))
+            if entry and entry['complete'] and entry['manufacturer'] and entry['model']:
+                manufacturers.add(slug_format(entry['manufacturer']))
+                keys.add((slug_format(entry['manufacturer']), entry['model']))
+            else:
+                manufacturers.add(slug_format(os.path.basename(os.path.dirname(file))))
+        return manufacturers, keys
 
-                # Save file location to resolve any relative paths for images
-                data['src'] = file
+    def get_files_of_keys(self, files: list, keys: set):
+        '''Return the files that define one of keys, given as manufacturer slug/model like the sync manifest
+
+        Files the index could not fully read are returned too, their key is
+        only known once they are parsed.
+        '''
+        if not keys:
+            return set()
+        index = self.get_index()
+        root = self.get_absolute_path()
+        selected = set()
+        for file in files:
+            entry = index.get(os.path.relpath(file, root))
+            if not entry or not entry['complete'] or not entry['manufacturer'] or not entry['model'] \
+                    or f"{slug_format(entry['manufacturer'])}/{entry['model']}" in keys:
+                selected.add(os.path.abspath(file))
+        return selected
+
+    def get_cache_keys(self, files: list):
+        '''Map each file to the key its parsed content is cached under
+
+        Files tracked and unmodified in git are keyed by their blob SHA, which
+        a single `git ls-files` call returns for the whole tree. Anything else
+        is keyed by path, modification time and size.
+        '''
+        blobs = {}
+        if self.repo:
+            try:
+                modified = set(self.repo.git.ls_files('-m', '-z').split('\0'))
+                for line in self.repo.git.ls_files('-s', '-z').split('\0'):
+                    if not line:
+                        continue
+                    info, path = line.split('\t', 1)
+                    if path not in modified:
+                        blobs[os.path.join(self.repo.working_tree_dir, path)] = info.split()[1]
+            except exc.GitCommandError as git_error:
+                self.handle.verbose_log("Could not list blob hashes: %s", git_error)
+
+        keys = []
+        for file in files:
+            blob = blobs.get(os.path.abspath(file))
+            if blob:
+                keys.append(f'blob:{blob}')
+            else:
+                stat = os.stat(file)
+                keys.append(f'stat:{os.path.abspath(file)}:{stat.st_mtime_ns}:{stat.st_size}')
+        return keys
 
-            if slugs and True not in [True if s.casefold() in data['slug'].casefold() else False for s in slugs]:
-                self.handle.verbose_log(f"Skipping {data['model']}")
+    def load_parse_cache(self):
+        empty = {'version': self.parse_cache_version, 'generation': 0, 'entries': {}}
+        if not self.parse_cache_file or not os.path.isfile(self.parse_cache_file):
+            return empty
+        try:
+            with open(self.parse_cache_file, 'rb') as stream:
+                cache = pickle.load(stream)
+        except Exception as cache_error:
+            self.handle.verbose_log("Ignoring unreadable parse cache: %s", cache_error)
+            return empty
+        if not isinstance(cache, dict) or cache.get('version') != self.parse_cache_version:
+            return empty
+        return cache
+
+    def save_parse_cache(self, cache):
+        '''Write the cache, evicting the least recently used entries'''
+        entries = cache['entries']
+        if len(entries) > self.parse_cache_size:
+            by_age = sorted(entries, key=lambda key: entries[key][0])
+            for key in by_age[:len(entries) - self.parse_cache_size]:
+                del entries[key]
+
+        write_atomically(self.parse_cache_file,
+                         lambda stream: pickle.dump(cache, stream, protocol=pickle.HIGHEST_PROTOCOL), binary=True)
+
+    def parse_cached(self, files: list):
+        '''Parse files lazily and in order, reusing earlier results for unchanged files
+
+        Hits are yielded as soon as the consumer asks for them, misses come
+        from parse_all, which only parses ahead of the consumer by a few
+        chunks. The cache is written once the generator is exhausted.
+        '''
+        if not files:
+            return
+        if not self.parse_cache_file:
+            yield from self.parse_all(files)
+            return
+
+        if self.parse_cache is None:
+            self.parse_cache = self.load_parse_cache()
+        cache = self.parse_cache
+        cache['generation'] += 1
+        entries = cache['entries']
+        keys = self.get_cache_keys(files)
+        misses = [file for file, key in zip(files, keys) if key not in entries]
+        self.handle.verbose_log("Parse cache: %s hits, %s misses", len(files) - len(misses), len(misses))
+
+        parsed = self.parse_all(misses)
+        for file, key in zip(files, keys):
+            entry = entries.get(key)
+            if entry is not None:
+                # Entries are stored pickled so every hit gets its own copy to mutate
+                entry[0] = cache['generation']
+                data = pickle.loads(entry[1])
+                data['src'] = file
+                yield data, None
                 continue
 
-            deviceTypes.append(data)
-        return deviceTypes
+            data, error = next(parsed)
+            if error is None:
+                cached = {key: value for key, value in data.items() if key != 'src'}
+                entries[key] = [cache['generation'], pickle.dumps(cached, protocol=pickle.HIGHEST_PROTOCOL)]
+            yield data, error
+
+        try:
+            self.save_parse_cache(cache)
+        except OSError as cache_error:
+            self.handle.verbose_log("Could not write parse cache: %s", cache_error)
+
+    def parse_all(self, files: list):
+        '''Parse files lazily and in order, fanned out over the parse pool when worthwhile
+
+        At most two chunks per worker are parsed ahead of the consumer.
+        '''
+        if self.parse_pool is None or len(files) < self.parse_chunk_size * 2:
+            for file in files:
+                yield parse_file(file)
+            return
+
+        pending = deque()
+        try:
+            for start in range(0, len(files), self.parse_chunk_size):
+                pending.append(self.parse_pool.submit(parse_file_chunk, files[start:start + self.parse_chunk_size]))
+                if len(pending) >= self.parse_workers * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            # A consumer that stopped early leaves chunks nobody waits for
+            for future in pending:
+                future.cancel()
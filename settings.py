@@ -1,7 +1,8 @@
 from argparse import ArgumentParser
 import os
 from log_handler import LogHandler
-from repo import DTLRepo
+from metrics import PHASES, Metrics
+from repo import DTLRepo, start_parse_pool
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -11,7 +12,53 @@ REPO_BRANCH = os.getenv("REPO_BRANCH", default="master")
 NETBOX_URL = os.getenv("NETBOX_URL")
 NETBOX_TOKEN = os.getenv("NETBOX_TOKEN")
 IGNORE_SSL_ERRORS = (os.getenv("IGNORE_SSL_ERRORS", default="False") == "True")
-REPO_PATH = f"{os.path.dirname(os.path.realpath(__file__))}/repo"
+# Several NetBox instances to import into at once, as space separated URL=TOKEN pairs
+NETBOX_TARGETS = os.getenv("NETBOX_TARGETS", "").split()
+# Page size used when prefetching existing objects, NetBox caps it at MAX_PAGE_SIZE
+NETBOX_PAGE_SIZE = int(os.getenv("NETBOX_PAGE_SIZE", default=1000))
+# Number of component templates sent per bulk create request
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", default=500))
+# Number of device/module types imported concurrently
+WORKERS = int(os.getenv("WORKERS", default=1))
+# Number of processes used to parse the YAML files
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", default=os.cpu_count() or 1))
+# Attempts on connection errors and 429/502/503/504 responses
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", default=5))
+# Requests per second sent to NetBox, 0 for no limit
+RATE_LIMIT = float(os.getenv("RATE_LIMIT", default=0))
+# Most requests in flight at a time, lowered while NetBox is overloaded, 0 for one per pooled connection
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", default=0))
+# Seconds after which a response counts as a sign of an overloaded NetBox, 0 to only go by errors
+MAX_LATENCY = float(os.getenv("MAX_LATENCY", default=0))
+# History depth of the clone, 0 for the full history
+GIT_DEPTH = int(os.getenv("GIT_DEPTH", default=0))
+# Partial clone filter such as blob:none, blobs are then only fetched for checked out files
+GIT_FILTER = os.getenv("GIT_FILTER") or None
+# Only check out the folders of the selected vendors
+SPARSE_CHECKOUT = (os.getenv("SPARSE_CHECKOUT", default="False") == "True")
+# Directory or tarball of the library to import instead of cloning REPO_URL
+SNAPSHOT = os.getenv("SNAPSHOT") or None
+# Checkout of the library, shards running on the same host each need their own
+REPO_PATH = os.getenv("REPO_PATH", default=f"{os.path.dirname(os.path.realpath(__file__))}/repo")
+# Local state such as the parse cache, set CACHE_PATH to an empty value to disable it
+CACHE_PATH = os.getenv("CACHE_PATH", default=f"{os.path.dirname(os.path.realpath(__file__))}/.cache")
+# Maximum number of parsed files kept in the parse cache
+PARSE_CACHE_SIZE = int(os.getenv("PARSE_CACHE_SIZE", default=50000))
+# Keep running and sync on an interval, see --daemon
+DAEMON = (os.getenv("DAEMON", default="False") == "True")
+# Seconds between two polls of the library in daemon mode
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", default=60))
+# HOST:PORT of the health, stats and sync trigger endpoints in daemon mode, empty to disable them
+LISTEN = os.getenv("LISTEN", default="127.0.0.1:8080")
+# Import only one of several shards of the vendors, as INDEX/COUNT from 1/COUNT to COUNT/COUNT
+SHARD = os.getenv("SHARD") or None
+# Optional JSON file with the counters and failed files of the run, for --merge
+RESULT_FILE = os.getenv("RESULT_FILE")
+# Log output format, text or json (one JSON object per line)
+LOG_FORMAT = os.getenv("LOG_FORMAT", default="text")
+# Optional JSON report and Prometheus textfile collector file with the request metrics and phase timings
+METRICS_FILE = os.getenv("METRICS_FILE")
+PROMETHEUS_FILE = os.getenv("PROMETHEUS_FILE")
 
 # optionally load vendors through a comma separated list as env var
 VENDORS = list(filter(None, os.getenv("VENDORS", "").split(",")))
@@ -30,8 +77,56 @@ parser.add_argument('--url', '--git', default=REPO_URL,
                     help="Git URL with valid Device Type YAML files")
 parser.add_argument('--slugs', nargs='+', default=SLUGS,
                     help="List of device-type slugs to import eg. ap4431 ws-c3850-24t-l")
+parser.add_argument('--targets', nargs='+', default=NETBOX_TARGETS,
+                    help="Import into several NetBox instances at once, given as URL=TOKEN pairs")
 parser.add_argument('--branch', default=REPO_BRANCH,
                     help="Git branch to use from repo")
+parser.add_argument('--depth', type=int, default=GIT_DEPTH,
+                    help="Clone and fetch only this many commits of history, 0 for all")
+parser.add_argument('--filter', default=GIT_FILTER,
+                    help="Partial clone filter, e.g. blob:none")
+parser.add_argument('--sparse', action='store_true', default=SPARSE_CHECKOUT,
+                    help="Only check out the folders of the vendors given with --vendors")
+parser.add_argument('--snapshot', default=SNAPSHOT,
+                    help="Import from this directory or tarball of the library instead of git")
+parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                    help="Number of component templates sent per bulk create request")
+parser.add_argument('--workers', type=int, default=WORKERS,
+                    help="Number of device/module types imported concurrently")
+parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS,
+                    help="Number of processes used to parse the YAML files")
+parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT,
+                    help="Requests per second sent to NetBox, 0 for no limit")
+parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                    help="Most requests in flight at a time, lowered while NetBox is overloaded")
+parser.add_argument('--max-latency', type=float, default=MAX_LATENCY,
+                    help="Seconds after which a response counts as a sign of an overloaded NetBox")
+parser.add_argument('--full', action='store_true', default=False,
+                    help="Import and check every file, ignoring the last import state and sync manifest")
+parser.add_argument('--resume', action='store_true', default=False,
+                    help="Skip the types an interrupted run already imported, as recorded in its journal")
+parser.add_argument('--reconcile', action='store_true', default=False,
+                    help="Update existing component templates whose fields differ from the definition")
+parser.add_argument('--daemon', action='store_true', default=DAEMON,
+                    help="Keep running, pull the library and import its changes every --interval seconds")
+parser.add_argument('--interval', type=float, default=SYNC_INTERVAL,
+                    help="Seconds between two polls of the library in daemon mode")
+parser.add_argument('--listen', default=LISTEN,
+                    help="HOST:PORT serving /health, /stats and POST /sync in daemon mode, empty to disable")
+parser.add_argument('--shard', default=SHARD,
+                    help="Import one shard of the vendors, e.g. 2/4, run every shard in its own process or host")
+parser.add_argument('--result-file', default=RESULT_FILE,
+                    help="Write the counters and failed files of the run to this JSON file")
+parser.add_argument('--merge', nargs='+', default=None, metavar='RESULT_FILE',
+                    help="Combine the result files of the shards of an import into one report and exit")
+parser.add_argument('--metrics-file', default=METRICS_FILE,
+                    help="Write a JSON report of the requests and phase timings to this file")
+parser.add_argument('--prometheus-file', default=PROMETHEUS_FILE,
+                    help="Write the metrics to this file for the Prometheus textfile collector")
+parser.add_argument('--profile', choices=PHASES, default=None,
+                    help="Profile one phase of the run with cProfile, only its own thread, see --workers 1")
+parser.add_argument('--log-format', choices=['text', 'json'], default=LOG_FORMAT,
+                    help="Print log lines as text or as JSON objects")
 parser.add_argument('--verbose', action='store_true', default=False,
                     help="Print verbose output")
 
@@ -40,13 +135,40 @@ args = parser.parse_args()
 args.vendors = [v.casefold()
                 for vendor in args.vendors for v in vendor.split(",") if v.strip()]
 args.slugs = [s for slug in args.slugs for s in slug.split(",") if s.strip()]
+if args.daemon and args.listen and ':' not in args.listen:
+    parser.error("--listen expects HOST:PORT")
+if args.shard:
+    try:
+        args.shard = tuple(int(part) for part in args.shard.split('/'))
+    except ValueError:
+        args.shard = ()
+    if len(args.shard) != 2 or not 1 <= args.shard[0] <= args.shard[1]:
+        parser.error("--shard expects INDEX/COUNT with 1 <= INDEX <= COUNT, e.g. 2/4")
+    # Every shard keeps its journal, sync manifest, NetBox state and parse cache apart
+    if CACHE_PATH:
+        CACHE_PATH = os.path.join(CACHE_PATH, f'shard-{args.shard[0]}-of-{args.shard[1]}')
+for target in args.targets:
+    if '=' not in target:
+        parser.error("--targets expects URL=TOKEN pairs, got an entry without '='")
 
+# Forked before the log writer or any other thread is started
+parse_pool = None if args.merge else start_parse_pool(args.parse_workers)
 handle = LogHandler(args)
 # Evaluate environment variables and exit if one of the mandatory ones are not set
 MANDATORY_ENV_VARS = ["REPO_URL", "NETBOX_URL", "NETBOX_TOKEN"]
 for var in MANDATORY_ENV_VARS:
-    if var not in os.environ:
+    # A snapshot does not need the repository, targets replace NETBOX_URL and NETBOX_TOKEN,
+    # merging shard results needs neither
+    if var not in os.environ and not args.merge and not (var == "REPO_URL" and args.snapshot) \
+            and not (var in ("NETBOX_URL", "NETBOX_TOKEN") and args.targets):
         handle.exception("EnvironmentError", var,
                          f'Environment variable "{var}" is not set.\n\nMANDATORY_ENV_VARS: {str(MANDATORY_ENV_VARS)}.\n\nCURRENT_ENV_VARS: {str(os.environ)}')
 
-dtl_repo = DTLRepo(args, REPO_PATH, handle)
+# (url, token) of every NetBox to import into
+TARGETS = [tuple(target.rsplit('=', 1)) for target in args.targets] or [(NETBOX_URL, NETBOX_TOKEN)]
+
+metrics = Metrics(handle, args.profile)
+dtl_repo = None
+if not args.merge:
+    with metrics.phase('git'):
+        dtl_repo = DTLRepo(args, REPO_PATH, handle, CACHE_PATH, PARSE_CACHE_SIZE, parse_pool)
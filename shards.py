@@ -0,0 +1,101 @@
+from collections import Counter
+from datetime import datetime, timezone
+import json
+import os
+import zlib
+
+from atomic_file import write_atomically
+
+
+def get_shard(slug, count):
+    '''Return the shard, from 1 to count, that imports a vendor
+
+    crc32 rather than hash(), so every process and host assigns the same.
+    '''
+    return zlib.crc32(slug.encode()) % count + 1
+
+
+def get_result(shard, commit, vendors, targets, repo_path):
+    '''Summarize the import of one shard for merge_results
+
+    Args:
+    shard: (index, count), or None for an unsharded run
+    vendors: the vendors the shard imported
+    targets: the targets of the run, with their NetBox and whether their import failed
+    '''
+    result = {
+        'version': 1,
+        'shard': list(shard) if shard else None,
+        'commit': commit,
+        'finished': datetime.now(timezone.utc).isoformat(),
+        'vendors': sorted({vendor['slug'] for vendor in vendors}),
+        'targets': {},
+    }
+    for target in targets:
+        netbox = target.get('netbox')
+        failed_files = netbox.get_failed_sources() if netbox is not None and hasattr(netbox, 'device_types') else []
+        result['targets'][target['url']] = {
+            'failed': target.get('failed', False),
+            'counters': dict(getattr(netbox, 'counter', {})),
+            'failed_files': sorted(os.path.relpath(path, repo_path) for path in failed_files),
+        }
+    return result
+
+
+def save_result(path, result):
+    write_atomically(path, lambda stream: json.dump(result, stream, indent=2))
+
+
+def merge_results(paths):
+    '''Combine the results of the shards of one import into one report
+
+    Counters are summed and failed files collected per NetBox. Missing
+    shards, shards of different sizes and shards that imported different
+    commits are reported as problems.
+
+    Returns:
+    (merged result, list of problems)
+    '''
+    problems = []
+    results = []
+    for path in paths:
+        try:
+            with open(path, 'r') as stream:
+                results.append(json.load(stream))
+        except (OSError, ValueError) as result_error:
+            problems.append(f'Unreadable result {path}: {result_error}')
+
+    counts = {result['shard'][1] for result in results if result.get('shard')}
+    if len(counts) > 1:
+        problems.append(f'Results of different shard counts: {sorted(counts)}')
+    seen = Counter(tuple(result['shard']) for result in results if result.get('shard'))
+    for count in counts:
+        missing = [index for index in range(1, count + 1) if (index, count) not in seen]
+        if missing:
+            problems.append(f"Missing shards {', '.join(f'{index}/{count}' for index in missing)}")
+    duplicates = [f'{index}/{count}' for (index, count), times in seen.items() if times > 1]
+    if duplicates:
+        problems.append(f"Shards reported more than once: {', '.join(sorted(duplicates))}")
+    commits = {result.get('commit') for result in results}
+    if len(commits) > 1:
+        problems.append(f'Shards imported different commits: {sorted(str(commit) for commit in commits)}')
+
+    merged = {'version': 1, 'shards': len(results), 'commits': sorted(str(commit) for commit in commits),
+              'vendors': sorted({vendor for result in results for vendor in result['vendors']}), 'targets': {}}
+    for result in results:
+        for url, target in result['targets'].items():
+            entry = merged['targets'].setdefault(url, {'failed_shards': [], 'counters': Counter(),
+                                                       'failed_files': []})
+            if target['failed']:
+                entry['failed_shards'].append('/'.join(map(str, result['shard'] or [])) or 'unsharded')
+            entry['counters'].update(target['counters'])
+            entry['failed_files'].extend(target['failed_files'])
+    for url, entry in merged['targets'].items():
+        entry['counters'] = dict(entry['counters'])
+        entry['failed_files'] = sorted(entry['failed_files'])
+        if entry['failed_shards']:
+            problems.append(f"The import into {url} failed in shards {', '.join(entry['failed_shards'])}")
+        if entry['failed_files']:
+            problems.append(f"{len(entry['failed_files'])} files failed to import into {url}")
+    merged['problems'] = problems
+    return merged, problems
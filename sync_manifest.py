@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import threading
+
+from atomic_file import write_atomically
+
+
+class SyncManifest:
+    '''Content hashes and NetBox ids of the definitions imported into one NetBox
+
+    A definition whose hash is unchanged since it was last imported cleanly,
+    and whose object still exists, needs no API calls at all.
+    '''
+
+    # The manifests of all NetBox instances share one file
+    file_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        return super().__new__(cls)
+
+    def __init__(self, path, target, handle):
+        self.path = path
+        self.target = target
+        self.handle = handle
+        self.entries = {'device-types': {}, 'module-types': {}, 'images': {}}
+        # Keys of the entries whose object verify() found gone, imported again even if unchanged
+        self.dropped = {'device-types': set(), 'module-types': set()}
+        self.load()
+
+    @staticmethod
+    def hash_definition(definition):
+        '''Hash a parsed definition independent of key order, file location and image flags'''
+        content = definition.to_dict()
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def hash_file(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as stream:
+            for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def get_key(definition):
+        return f"{definition['manufacturer']['slug']}/{definition['model']}"
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as stream:
+                manifest = json.load(stream)
+        except (OSError, ValueError) as manifest_error:
+            self.handle.verbose_log("Ignoring unreadable sync manifest: %s", manifest_error)
+            return
+        for kind, entries in manifest.get(self.target, {}).items():
+            self.entries.setdefault(kind, {}).update(entries)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.file_lock:
+            manifest = {}
+            if os.path.isfile(self.path):
+                try:
+                    with open(self.path, 'r') as stream:
+                        manifest = json.load(stream)
+                except (OSError, ValueError):
+                    manifest = {}
+            manifest[self.target] = self.entries
+            write_atomically(self.path, lambda stream: json.dump(manifest, stream))
+
+    def verify(self, existing, manufacturer_slugs=None):
+        '''Find the entries whose object no longer exists
+
+        They are no longer current, but kept until their definition was
+        imported again, so a run that dies before that still finds them.
+
+        Args:
+        existing: {kind: set of the ids NetBox has}
+        manufacturer_slugs: manufacturers existing covers, None for all
+        '''
+        self.dropped = {'device-types': set(), 'module-types': set()}
+        for kind, entries in self.entries.items():
+            if not entries or kind not in existing:
+                continue
+            if manufacturer_slugs is not None:
+                entries = {key: entry for key, entry in entries.items()
+                           if key.split('/', 1)[0] in manufacturer_slugs}
+            self.dropped[kind] = {key for key, (_, object_id) in entries.items() if object_id not in existing[kind]}
+            self.handle.verbose_log('Sync manifest: %s %s verified, %s missing',
+                                    len(entries) - len(self.dropped[kind]), kind, len(self.dropped[kind]))
+
+    def is_current(self, kind, key, digest):
+        entry = self.entries[kind].get(key)
+        return entry is not None and entry[0] == digest and key not in self.dropped[kind]
+
+    def record(self, kind, key, digest, object_id):
+        self.entries[kind][key] = [digest, object_id]
+        self.dropped[kind].discard(key)
+
+    def get_id(self, kind, key):
+        entry = self.entries[kind].get(key)
+        return entry[1] if entry else None
+
+    def has_image(self, device_type, side):
+        return f'{device_type}/{side}' in self.entries['images']
+
+    def image_changed(self, device_type, side, path, reported_size=None, recorded=True):
+        '''Compare a local image with the one last uploaded for this device type
+
+        The file is only hashed when its size or modification time differ
+        from the recorded upload. Without a record, or with recorded=False
+        to disregard it, an image NetBox reports with the same size is taken
+        as identical and recorded.
+        '''
+        stat = os.stat(path)
+        entry = self.entries['images'].get(f'{device_type}/{side}') if recorded else None
+        if entry is None:
+            if reported_size != stat.st_size:
+                return True
+            self.record_image(device_type, side, path)
+            return False
+        digest, size, mtime = entry
+        if size != stat.st_size:
+            return True
+        if mtime == stat.st_mtime_ns:
+            return False
+        if self.hash_file(path) != digest:
+            return True
+        entry[2] = stat.st_mtime_ns
+        return False
+
+    def record_image(self, device_type, side, path):
+        stat = os.stat(path)
+        self.entries['images'][f'{device_type}/{side}'] = [self.hash_file(path), stat.st_size, stat.st_mtime_ns]
+
+    def forget_image(self, device_type, side):
+        self.entries['images'].pop(f'{device_type}/{side}', None)